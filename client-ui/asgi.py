@@ -0,0 +1,290 @@
+"""
+Async (ASGI) serving mode of the client UI.
+
+The API endpoints called by the dashboard (/api/flights, /api/flights/batch, /api/cities,
+/api/ond-pairs, /api/username) are served by async views: PostgreSQL queries go through an async
+psycopg pool, Cognito and DynamoDB calls run in threads. A slow percentile query
+holds a connection, not a worker, and the number of flights queries running at the
+same time is capped so that the other endpoints always get a connection. The OnDs of
+a batch are queried concurrently, each on a connection of its own.
+Queries, cache keys and the result cache are the ones of server.py, the other
+routes (login, pages) are served by its Flask app.
+
+> uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import os
+
+import psycopg
+from psycopg import sql as async_sql
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from psycopg2 import sql
+from a2wsgi import WSGIMiddleware
+from flask import json
+from flask_cognito_lib.exceptions import AuthorisationRequiredError
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+
+import server
+
+# max number of /api/flights and /api/flights/batch queries running at the same time
+DB_MAX_IN_FLIGHT = int(os.getenv('DB_MAX_IN_FLIGHT', max(1, int(os.getenv('DB_POOL_MAX', 10)) // 2)))
+
+db_pool = AsyncConnectionPool(
+    make_conninfo(
+        dbname=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+    ),
+    min_size=int(os.getenv('DB_POOL_MIN', 1)),
+    max_size=int(os.getenv('DB_POOL_MAX', 10)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+    max_idle=float(os.getenv('DB_POOL_CHECK_INTERVAL', 30)),
+    check=AsyncConnectionPool.check_connection,
+    open=False,
+)
+flights_slots = None
+watermark = {"version": None}
+
+
+def to_async_sql(query):
+    # server.py builds its queries with psycopg2.sql, psycopg 3 has the same objects
+    if isinstance(query, sql.Composed):
+        return async_sql.Composed([to_async_sql(part) for part in query.seq])
+    if isinstance(query, sql.Literal):
+        return async_sql.Literal(query.wrapped)
+    if isinstance(query, sql.Identifier):
+        return async_sql.Identifier(*query.strings)
+    return async_sql.SQL(query.string)
+
+
+async def fetch_rows(query):
+    try:
+        async with db_pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(to_async_sql(query))
+                columns = [desc.name for desc in cursor.description]
+                return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+    except (psycopg.OperationalError, PoolTimeout) as e:
+        print(f"The error '{e}' occurred")
+        raise server.DatabaseUnavailable()
+
+
+async def iter_rows(query):
+    # rows read through a server side cursor, as the query produces them
+    try:
+        async with db_pool.connection() as connection:
+            async with connection.cursor(name='flights_rows') as cursor:
+                await cursor.execute(to_async_sql(query))
+                columns = [desc.name for desc in cursor.description]
+                async for row in cursor:
+                    yield dict(zip(columns, row))
+    except (psycopg.OperationalError, PoolTimeout) as e:
+        print(f"The error '{e}' occurred")
+        raise server.DatabaseUnavailable()
+
+
+async def refresh_watermark():
+    # read in the background instead of on the request path
+    while True:
+        version = None
+        try:
+            rows = await fetch_rows(server.WATERMARK_QUERY)
+            if rows:
+                version = rows[0]['version']
+        except Exception as e:
+            print(f"Watermark not available: {e}")
+        watermark["version"] = version
+        await asyncio.sleep(server.WATERMARK_CHECK_INTERVAL)
+
+
+async def cached_response(request, key, compute):
+    version = watermark["version"]
+    body = server.result_cache.get(key, version)
+    if body is None:
+        body = json.dumps(await compute()).encode('utf-8')
+        server.result_cache.put(key, version, body)
+    return json_response(request, body)
+
+
+def json_response(request, body):
+    etag = hashlib.md5(body).hexdigest()
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+async def run_query(request, cache_key, compute):
+    try:
+        return await cached_response(request, cache_key, compute)
+    except server.DatabaseUnavailable:
+        return JSONResponse({"error": "Connection to database failed"}, status_code=500)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return JSONResponse({"error": "Failed to fetch data"}, status_code=500)
+
+
+async def get_flights(request):
+    args = MultiDict(request.query_params.multi_items())
+    query, cache_keys = server.flights_query(args)
+    try:
+        after, limit = server.flights_page(args)
+    except ValueError:
+        return JSONResponse({"error": "Invalid after or limit parameter"}, status_code=400)
+
+    if args.get('stream', 'false').lower() == 'true':
+        async def generate():
+            try:
+                async with flights_slots:
+                    async for row in iter_rows(server.page_query(query, after, limit)):
+                        yield json.dumps(row).encode('utf-8') + b'\n'
+            except server.DatabaseUnavailable:
+                yield b'{"error": "Connection to database failed"}\n'
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                yield b'{"error": "Failed to fetch data"}\n'
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    if limit is None:
+        async def compute():
+            async with flights_slots:
+                return await fetch_rows(query)
+
+        return await run_query(request, cache_keys[0], compute)
+
+    async def compute_page():
+        async with flights_slots:
+            return server.page_result(await fetch_rows(server.page_query(query, after, limit + 1)), limit)
+
+    return await run_query(request, cache_keys[0] + ('page', after, limit), compute_page)
+
+
+async def flights_batch(args, onds, version):
+    # same as server.flights_batch, but with one query per OnD, run concurrently within
+    # the flights_slots cap: cached OnDs first, then the queried ones as they complete
+    cached, missing, _ = server.flights_batch_lookup(args, onds, version)
+    for ond, body in cached:
+        yield ond, body
+
+    async def fetch(ond):
+        async with flights_slots:
+            return ond, await fetch_rows(server.flights_query(args, [ond])[0])
+
+    tasks = [asyncio.ensure_future(fetch(ond)) for ond in missing]
+    try:
+        for task in asyncio.as_completed(tasks):
+            ond, rows = await task
+            yield ond, server.flights_batch_store(ond, rows, missing, version)
+    finally:
+        # client gone or query failed: the other queries are not needed anymore
+        for task in tasks:
+            task.cancel()
+
+
+async def get_flights_batch(request):
+    args = MultiDict(request.query_params.multi_items())
+    onds = server.flights_onds(args)
+    error = server.flights_onds_error(onds)
+    if error is not None:
+        return JSONResponse(error, status_code=400)
+    results = flights_batch(args, onds, watermark["version"])
+
+    if args.get('stream', 'false').lower() == 'true':
+        async def generate():
+            try:
+                async for ond, body in results:
+                    yield server.flights_batch_line(ond, body)
+            except server.DatabaseUnavailable:
+                yield b'{"error": "Connection to database failed"}\n'
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                yield b'{"error": "Failed to fetch data"}\n'
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    try:
+        bodies = {ond: body async for ond, body in results}
+    except server.DatabaseUnavailable:
+        return JSONResponse({"error": "Connection to database failed"}, status_code=500)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return JSONResponse({"error": "Failed to fetch data"}, status_code=500)
+    body = b'{' + b', '.join(json.dumps(ond).encode('utf-8') + b': ' + bodies[ond] for ond in onds) + b'}'
+    return json_response(request, body)
+
+
+async def get_cities(request):
+    prefix = server.cities_prefix(request.query_params)
+
+    async def compute():
+        return server.cities_from_rows(await fetch_rows(server.cities_query(prefix)), prefix)
+
+    return await run_query(request, ('cities', prefix), compute)
+
+
+def authenticate(cookie):
+    # auth_required and the session need a Flask request context
+    with server.app.test_request_context(headers={'Cookie': cookie}):
+        try:
+            return server.current_user_info()
+        except AuthorisationRequiredError:
+            return None
+
+
+def fetch_ond_pairs(username, refresh):
+    with server.app.app_context():
+        return server.fetch_ond_pairs(username, refresh)
+
+
+async def get_ond_pairs(request):
+    user_info = await asyncio.to_thread(authenticate, request.headers.get('cookie', ''))
+    if user_info is None:
+        return JSONResponse({"error": "Authentication required"}, status_code=401)
+    refresh = request.query_params.get('refresh', 'false').lower() == 'true'
+    return JSONResponse(await asyncio.to_thread(fetch_ond_pairs, user_info['cognito:username'], refresh))
+
+
+async def get_username(request):
+    user_info = await asyncio.to_thread(authenticate, request.headers.get('cookie', ''))
+    if user_info is None:
+        return JSONResponse({"error": "Authentication required"}, status_code=401)
+    return JSONResponse(user_info['cognito:username'])
+
+
+async def get_pool_stats(request):
+    return JSONResponse(db_pool.get_stats())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global flights_slots
+    flights_slots = asyncio.Semaphore(DB_MAX_IN_FLIGHT)
+    # the app starts without the database, connections are opened in the background
+    await db_pool.open(wait=False)
+    watermark_task = asyncio.create_task(refresh_watermark())
+    yield
+    watermark_task.cancel()
+    await db_pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/flights', get_flights),
+        Route('/api/flights/batch', get_flights_batch),
+        Route('/api/cities', get_cities),
+        Route('/api/ond-pairs', get_ond_pairs),
+        Route('/api/username', get_username),
+        Route('/api/pool-stats', get_pool_stats),
+        Mount('/', app=WSGIMiddleware(server.app)),
+    ],
+    lifespan=lifespan,
+)
@@ -1,9 +1,18 @@
 import os
-from flask import Flask, jsonify, request, redirect, render_template, url_for, session
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, json, jsonify, request, redirect, render_template, url_for, session
 from flask_cors import CORS
 import psycopg2
 from psycopg2 import OperationalError, sql
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from flask_dynamo import Dynamo
+from botocore.exceptions import ClientError
 
 from flask_cognito_lib import CognitoAuth
 from flask_cognito_lib.decorators import (
@@ -36,6 +45,10 @@ app.config['DYNAMO_TABLES'] = [
          'ProvisionedThroughput':dict(ReadCapacityUnits=5, WriteCapacityUnits=5)
     }
  ]
+# DynamoDB Local (or moto in server mode) instead of AWS, e.g. for tests
+app.config['DYNAMO_ENABLE_LOCAL'] = os.environ.get('DYNAMO_ENABLE_LOCAL', 'false').lower() == 'true'
+app.config['DYNAMO_LOCAL_HOST'] = os.environ.get('DYNAMO_LOCAL_HOST', 'localhost')
+app.config['DYNAMO_LOCAL_PORT'] = int(os.environ.get('DYNAMO_LOCAL_PORT', 8000))
 
 # Instantiate a table resource object without actually
 # creating a DynamoDB table. Note that the attributes of this table
@@ -78,18 +91,47 @@ def postlogin():
 @app.route('/api/ond-pairs')
 @auth_required()
 def get_ond_pairs():
-    response = dynamo.tables['AirlineOnDPairs'].get_item(
-        Key={
-            'username': session['user_info']['cognito:username'].upper()
-        })
-    items = response.get('Item', {})
-    return jsonify(items)
+    # refresh=true reads the pairs from DynamoDB again, e.g. after they were edited
+    refresh = request.args.get('refresh', 'false').lower() == 'true'
+    return jsonify(fetch_ond_pairs(session['user_info']['cognito:username'], refresh))
+
+# OnD pairs per user: they rarely change, and reads are throttled at peak
+OND_PAIRS_CACHE_TTL = float(os.getenv('OND_PAIRS_CACHE_TTL', 600))
+ond_pairs_cache = {}
+ond_pairs_lock = threading.Lock()
+
+def fetch_ond_pairs(username, refresh=False):
+    username = username.upper()
+    with ond_pairs_lock:
+        entry = ond_pairs_cache.get(username)
+    if entry is not None and not refresh and time.monotonic() - entry[1] < OND_PAIRS_CACHE_TTL:
+        return entry[0]
+    try:
+        response = dynamo.tables['AirlineOnDPairs'].get_item(
+            Key={
+                'username': username
+            })
+    except ClientError as e:
+        # throttled: the pairs read before are better than an error
+        if entry is None or e.response['Error']['Code'] != 'ProvisionedThroughputExceededException':
+            raise
+        print(f"OnD pairs of {username} served from the cache: {e}")
+        return entry[0]
+    item = response.get('Item', {})
+    with ond_pairs_lock:
+        ond_pairs_cache[username] = (item, time.monotonic())
+    return item
 
 @app.route('/api/username')
 @auth_required()
 def get_username():
     return jsonify(session['user_info']['cognito:username'])
 
+@auth_required()
+def current_user_info():
+    # user of the current request, for the async serving mode (asgi.py)
+    return session['user_info']
+
 @app.route("/logout")
 @cognito_logout
 def logout():
@@ -119,52 +161,365 @@ def dashboard():
         return redirect(url_for("login"))
     return render_template("dashboard.html")
 
-def create_connection():
-    load_dotenv()
+class ConnectionPool:
+    """
+    Bounded pool of PostgreSQL connections shared by the API endpoints.
+    Callers wait up to `timeout` seconds for a free connection. Connections idle for
+    more than `check_interval` seconds are checked with a SELECT 1 before being used.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, check_interval, **connect_kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.metrics = {
+            "checkouts": 0,
+            "in_use": 0,
+            "waited": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "discarded": 0,
+        }
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.metrics["timeouts"] += 1
+            raise PoolError(f"No connection available after {self.timeout} seconds")
+        wait_time = time.monotonic() - start
+        try:
+            # after a database restart, all the idle connections can be broken: each pooled
+            # connection is checked at most once, new connections are not checked
+            for _ in range(self.maxconn + 1):
+                connection = self.pool.getconn()
+                if self.is_healthy(connection):
+                    break
+                self.discard(connection)
+            else:
+                raise PoolError("No healthy connection available")
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["in_use"] += 1
+            if wait_time > 0.001:
+                self.metrics["waited"] += 1
+            self.metrics["wait_time_total"] += wait_time
+            self.metrics["wait_time_max"] = max(self.metrics["wait_time_max"], wait_time)
+        return connection
+
+    def is_healthy(self, connection):
+        if connection.closed:
+            return False
+        last_used = self.last_used.get(id(connection))
+        if last_used is None or time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, connection):
+        self.last_used.pop(id(connection), None)
+        self.pool.putconn(connection, close=True)
+        with self.lock:
+            self.metrics["discarded"] += 1
+
+    def putconn(self, connection):
+        try:
+            # ends the transaction opened by the queries
+            if not connection.closed:
+                connection.rollback()
+        except psycopg2.Error:
+            pass
+        if connection.closed:
+            self.discard(connection)
+        else:
+            self.last_used[id(connection)] = time.monotonic()
+            self.pool.putconn(connection)
+        with self.lock:
+            self.metrics["in_use"] -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics, max_size=self.maxconn)
+        if stats["checkouts"] > 0:
+            stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"]
+        return stats
+
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # the pool is created on first use, so that the app starts without the database
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = ConnectionPool(
+                int(os.getenv('DB_POOL_MIN', 1)),
+                int(os.getenv('DB_POOL_MAX', 10)),
+                float(os.getenv('DB_POOL_TIMEOUT', 5)),
+                float(os.getenv('DB_POOL_CHECK_INTERVAL', 30)),
+                database=os.getenv('DB_NAME'),
+                user=os.getenv('DB_USER'),
+                password=os.getenv('DB_PASSWORD'),
+                host=os.getenv('DB_HOST'),
+                port=os.getenv('DB_PORT'),
+            )
+            print("Connection pool to PostgreSQL DB created")
+    return db_pool
 
-    db_name = os.getenv('DB_NAME')
-    db_user = os.getenv('DB_USER')
-    db_password = os.getenv('DB_PASSWORD')
-    db_host = os.getenv('DB_HOST')
-    db_port = os.getenv('DB_PORT')
+
+def get_connection():
     connection = None
     try:
-        connection = psycopg2.connect(
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            host=db_host,
-            port=db_port,
-        )
-        print("Connection to PostgreSQL DB successful")
-    except OperationalError as e:
+        connection = get_pool().getconn()
+    except (OperationalError, PoolError) as e:
         print(f"The error '{e}' occurred")
     return connection
 
+
+def release_connection(connection):
+    get_pool().putconn(connection)
+
+
+class ResultCache:
+    """
+    LRU cache of JSON responses, with a TTL. Each entry records the data watermark
+    it was computed at, and is stale as soon as the writer has loaded new data.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "expired": 0, "stale": 0, "evictions": 0}
+
+    def get(self, key, watermark):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            body, entry_watermark, created = entry
+            if time.monotonic() - created > self.ttl:
+                self.metrics["expired"] += 1
+            elif watermark != entry_watermark:
+                self.metrics["stale"] += 1
+            else:
+                self.metrics["hits"] += 1
+                self.entries.move_to_end(key)
+                return body
+            del self.entries[key]
+            return None
+
+    def put(self, key, watermark, body):
+        with self.lock:
+            self.entries[key] = (body, watermark, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, size=len(self.entries), max_size=self.max_size)
+
+
+result_cache = ResultCache(
+    int(os.getenv('RESULT_CACHE_SIZE', 1000)),
+    float(os.getenv('RESULT_CACHE_TTL', 300)),
+)
+
+# version of the data, as written by decoratedRecoWriter in the watermark table
+WATERMARK_CHECK_INTERVAL = float(os.getenv('WATERMARK_CHECK_INTERVAL', 5))
+watermark = {"version": None, "checked": None}
+watermark_lock = threading.Lock()
+WATERMARK_QUERY = sql.SQL("SELECT version FROM ingest_watermark WHERE name = 'flight_recos'")
+
+
+def get_watermark():
+    # read at most every WATERMARK_CHECK_INTERVAL seconds
+    with watermark_lock:
+        checked = watermark["checked"]
+        if checked is not None and time.monotonic() - checked < WATERMARK_CHECK_INTERVAL:
+            return watermark["version"]
+        watermark["checked"] = time.monotonic()
+    version = None
+    try:
+        rows = fetch_rows(WATERMARK_QUERY)
+        if rows:
+            version = rows[0]['version']
+    except Exception as e:
+        # no watermark: entries only expire with the TTL
+        print(f"Watermark not available: {e}")
+    with watermark_lock:
+        watermark["version"] = version
+    return version
+
+
+def cached_response(key, compute):
+    # JSON response from the cache, or computed and cached. The ETag lets browsers
+    # revalidate their copy and get a 304 when the data did not change.
+    version = get_watermark()
+    body = result_cache.get(key, version)
+    if body is None:
+        body = json.dumps(compute()).encode('utf-8')
+        result_cache.put(key, version, body)
+    return json_response(body)
+
+
+def json_response(body):
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/cache-stats')
+def get_cache_stats():
+    return jsonify(result_cache.stats())
+
+
+@app.route('/api/pool-stats')
+def get_pool_stats():
+    if db_pool is None:
+        return jsonify({})
+    return jsonify(db_pool.stats())
+
 @app.route('/api/flights', methods=['GET'])
 def get_flights():
-    filters = request.args.get('filters').lower() == 'true'
-    origin = request.args.get('origin', '')
-    destination = request.args.get('destination', '')
-    trip_type = request.args.get('trip_type', '')
-    ond = f"{origin}-{destination}"
-    nb_connections_min = request.args.get('nb_connections_min', type=int)
-    nb_connections_max = request.args.get('nb_connections_max', type=int)
-    cabin = request.args.get('cabin', '')
-    passenger_type = request.args.get('passenger_type', '')
-    search_date_start = request.args.get('search_date_start', '')
-    search_date_end = request.args.get('search_date_end', '')
-    departure_date_start = request.args.get('departure_date_start', '')
-    departure_date_end = request.args.get('departure_date_end', '')
-    min_stay_duration = request.args.get('min_stay_input', '', type=int)
-    max_stay_duration = request.args.get('max_stay_input', '', type=int)
+    query, cache_keys = flights_query(request.args)
+    try:
+        after, limit = flights_page(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid after or limit parameter"}), 400
+
+    if request.args.get('stream', 'false').lower() == 'true':
+        # one JSON line per row, read through a server side cursor: not cached
+        def generate():
+            try:
+                for row in iter_rows(page_query(query, after, limit)):
+                    yield json.dumps(row).encode('utf-8') + b'\n'
+            except DatabaseUnavailable:
+                yield b'{"error": "Connection to database failed"}\n'
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                yield b'{"error": "Failed to fetch data"}\n'
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+
+    if limit is None:
+        return run_flights_query(query, cache_keys[0])
+    query = page_query(query, after, limit + 1)
+    return run_cached(cache_keys[0] + ('page', after, limit), lambda: page_result(fetch_rows(query), limit))
+
+
+FLIGHTS_PAGE_MAX = int(os.getenv('FLIGHTS_PAGE_MAX', 1000))
+
+
+def flights_page(args):
+    # keyset pagination: after=<ond>,<advance purchase>,<airline> of the last row of the previous page
+    after = args.get('after')
+    if after:
+        ond, adv_purchase, main_airline = after.split(',')
+        after = (ond, int(adv_purchase), main_airline)
+    else:
+        after = None
+    limit = args.get('limit', type=int)
+    if after is not None and limit is None:
+        limit = FLIGHTS_PAGE_MAX
+    if limit is not None and not 0 < limit <= FLIGHTS_PAGE_MAX:
+        raise ValueError(f"limit must be between 1 and {FLIGHTS_PAGE_MAX}")
+    return after, limit
+
+
+def page_query(query, after=None, limit=None):
+    # rows of the flights queries following `after` in their (ond, advance purchase desc, airline) order
+    conditions = sql.SQL("TRUE")
+    if after is not None:
+        ond, adv_purchase, main_airline = after
+        conditions = sql.SQL("(ond, -adv_purchase, main_airline) > ({}, {}, {})").format(
+            sql.Literal(ond), sql.Literal(-adv_purchase), sql.Literal(main_airline))
+    query = sql.SQL("""
+        SELECT * FROM ({query}) AS page
+        WHERE {conditions}
+        ORDER BY ond, adv_purchase DESC, main_airline
+    """).format(query=query, conditions=conditions)
+    if limit is not None:
+        query += sql.SQL("LIMIT {}").format(sql.Literal(limit))
+    return query
+
+
+def page_result(rows, limit):
+    # rows holds one row more than the page when there is a next page
+    page = rows[:limit]
+    next_page = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_page = f"{last['ond']},{last['adv_purchase']},{last['main_airline']}"
+    return {"flights": page, "next": next_page}
+
+
+def flights_query(args, onds=None):
+    # query and cache keys (one per OnD) of /api/flights and /api/flights/batch,
+    # shared with the async serving mode (asgi.py)
+    filters = args.get('filters').lower() == 'true'
+    if onds is None:
+        origin = args.get('origin', '')
+        destination = args.get('destination', '')
+        onds = [f"{origin}-{destination}"]
+    trip_type = args.get('trip_type', '')
+    nb_connections_min = args.get('nb_connections_min', type=int)
+    nb_connections_max = args.get('nb_connections_max', type=int)
+    cabin = args.get('cabin', '')
+    passenger_type = args.get('passenger_type', '')
+    search_date_start = args.get('search_date_start', '')
+    search_date_end = args.get('search_date_end', '')
+    departure_date_start = args.get('departure_date_start', '')
+    departure_date_end = args.get('departure_date_end', '')
+    min_stay_duration = args.get('min_stay_input', '', type=int)
+    max_stay_duration = args.get('max_stay_input', '', type=int)
+
+    approx = args.get('approx', 'false').lower() == 'true'
 
     if min_stay_duration == '' or max_stay_duration == '':
         min_stay_duration = -1
         max_stay_duration = -1
 
+    # the rollup has no connections, passengers nor stay duration: exact query for those filters
+    if approx and filters and (nb_connections_min is not None or nb_connections_max is not None
+                               or passenger_type or min_stay_duration != -1 or max_stay_duration != -1):
+        approx = False
+
+    # cache key: only the parameters used by the query
+    key_params = (approx, filters)
+    if filters:
+        key_params += (trip_type, cabin, search_date_start, search_date_end, departure_date_start, departure_date_end)
+        if not approx:
+            key_params += (nb_connections_min, nb_connections_max, passenger_type, min_stay_duration, max_stay_duration)
+    cache_keys = [('flights', ond) + key_params for ond in onds]
+
+    if approx:
+        query = approx_flights_query(onds, filters, trip_type, cabin, search_date_start, search_date_end,
+                                     departure_date_start, departure_date_end)
+        return query, cache_keys
+
     conditions = [
-        sql.SQL("ond = {}").format(sql.Literal(ond))
+        sql.SQL("ond = ANY({})").format(sql.Literal(list(onds)))
     ]
 
     if filters:
@@ -204,56 +559,266 @@ def get_flights():
         ) AS t
         GROUP BY
             advance_purchase, ond, main_airline
-        ORDER BY advance_purchase DESC;
+        ORDER BY ond, advance_purchase DESC, main_airline
     """).format(conditions=sql.SQL(' AND ').join(conditions))
 
     # Note: the end dates are exclusive
     # For example, if time < 2021-01-01, it means time is less than 2021-01-01 00:00:00
 
-    connection = create_connection()
-    print(query.as_string(connection))
-    if connection:
-        try:
-            cursor = connection.cursor()
-            cursor.execute(query)
-            result = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            data = [dict(zip(columns, row)) for row in result]
-            return jsonify(data)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return jsonify({"error": "Failed to fetch data"}), 500
-        finally:
-            cursor.close()
-            connection.close()
+    return query, cache_keys
+
+
+def approx_flights_query(onds, filters, trip_type, cabin, search_date_start, search_date_end,
+                         departure_date_start, departure_date_end):
+    # Approximate median from the rollup table maintained by decoratedRecoWriter:
+    # number of searches per min price bin, per OnD, airline, advance purchase, trip type,
+    # cabin and search day. The median is the center of the bin holding the middle search,
+    # or the mean of the centers of the bins holding the two middle searches.
+    conditions = [
+        sql.SQL("ond = ANY({})").format(sql.Literal(list(onds)))
+    ]
+
+    if filters:
+        conditions += [
+            sql.SQL("trip_type = {}").format(sql.Literal(trip_type)),
+            sql.SQL("cabin = {}").format(sql.Literal(cabin)),
+            sql.SQL("day >= {} AND day < {}").format(sql.Literal(search_date_start), sql.Literal(search_date_end)),
+            sql.SQL("day + advance_purchase >= {} AND day + advance_purchase < {}").format(sql.Literal(departure_date_start), sql.Literal(departure_date_end)),
+        ]
     else:
+        # min price over all cabins
+        conditions.append(sql.SQL("cabin = '*'"))
+
+    return sql.SQL("""
+        SELECT
+            (MIN(bin_price) FILTER (WHERE cumulated >= FLOOR((total + 1) / 2.0))
+             + MIN(bin_price) FILTER (WHERE cumulated >= FLOOR(total / 2.0) + 1)) / 2 AS median_price,
+            advance_purchase AS adv_purchase,
+            main_airline,
+            ond
+        FROM (
+            SELECT
+                bin_price,
+                main_airline,
+                advance_purchase,
+                ond,
+                SUM(searches) OVER (PARTITION BY advance_purchase, ond, main_airline ORDER BY price_bin) AS cumulated,
+                SUM(searches) OVER (PARTITION BY advance_purchase, ond, main_airline) AS total
+            FROM (
+                SELECT
+                    price_bin,
+                    MIN(bin_price) AS bin_price,
+                    main_airline,
+                    advance_purchase,
+                    ond,
+                    SUM(searches) AS searches
+                FROM
+                    flight_recos_rollup
+                WHERE
+                    {conditions}
+                GROUP BY
+                    price_bin,
+                    main_airline,
+                    advance_purchase,
+                    ond
+            ) AS bins
+        ) AS t
+        GROUP BY
+            advance_purchase, ond, main_airline
+        ORDER BY ond, advance_purchase DESC, main_airline
+    """).format(conditions=sql.SQL(' AND ').join(conditions))
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+def fetch_rows(query):
+    connection = get_connection()
+    if connection is None:
+        raise DatabaseUnavailable()
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(query.as_string(connection))
+    try:
+        cursor = connection.cursor()
+        cursor.execute(query)
+        result = cursor.fetchall()
+        columns = [desc[0] for desc in cursor.description]
+        return [dict(zip(columns, row)) for row in result]
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def run_flights_query(query, cache_key):
+    return run_cached(cache_key, lambda: fetch_rows(query))
+
+
+def run_cached(cache_key, compute):
+    try:
+        return cached_response(cache_key, compute)
+    except DatabaseUnavailable:
+        return jsonify({"error": "Connection to database failed"}), 500
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return jsonify({"error": "Failed to fetch data"}), 500
+
+
+FLIGHTS_BATCH_MAX_ONDS = int(os.getenv('FLIGHTS_BATCH_MAX_ONDS', 50))
+
+
+def flights_onds(args):
+    # OnDs of /api/flights/batch, as repeated parameters: ond=PAR-LIS&ond=NCE-AMS
+    onds = []
+    for ond in args.getlist('ond'):
+        ond = ond.strip().upper()
+        if ond and ond not in onds:
+            onds.append(ond)
+    return onds
+
+
+OND_PATTERN = re.compile(r'[A-Z0-9]{3}-[A-Z0-9]{3}')
+
+
+def flights_onds_error(onds):
+    # error body of /api/flights/batch for a bad list of OnDs, None when the list is valid
+    if not onds or len(onds) > FLIGHTS_BATCH_MAX_ONDS:
+        return {"error": f"Between 1 and {FLIGHTS_BATCH_MAX_ONDS} OnDs are required"}
+    invalid = [ond for ond in onds if not OND_PATTERN.fullmatch(ond)]
+    if invalid:
+        return {"error": "OnDs must be two city codes: PAR-LIS", "invalid": invalid}
+    return None
+
+
+def flights_batch_lookup(args, onds, version):
+    # cached results, cache keys of the OnDs to query and the grouped query for them
+    _, cache_keys = flights_query(args, onds)
+    cached = []
+    missing = {}
+    for ond, key in zip(onds, cache_keys):
+        body = result_cache.get(key, version)
+        if body is None:
+            missing[ond] = key
+        else:
+            cached.append((ond, body))
+    query = flights_query(args, list(missing))[0] if missing else None
+    return cached, missing, query
+
+
+def flights_batch_store(ond, rows, missing, version):
+    body = json.dumps(rows).encode('utf-8')
+    result_cache.put(missing.pop(ond), version, body)
+    return body
+
+
+def flights_batch_line(ond, body):
+    return b'{"ond": ' + json.dumps(ond).encode('utf-8') + b', "flights": ' + body + b'}\n'
+
+
+def iter_rows(query):
+    # rows read through a server side cursor, as the query produces them
+    connection = get_connection()
+    if connection is None:
+        raise DatabaseUnavailable()
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(query.as_string(connection))
+    try:
+        with connection.cursor(name='flights_rows') as cursor:
+            cursor.execute(query)
+            columns = None
+            for row in cursor:
+                if columns is None:
+                    columns = [desc[0] for desc in cursor.description]
+                yield dict(zip(columns, row))
+    finally:
+        release_connection(connection)
+
+
+def flights_batch(args, onds, version):
+    # (OnD, JSON body) of the cached OnDs first, then of the queried ones as they complete
+    cached, missing, query = flights_batch_lookup(args, onds, version)
+    yield from cached
+    if query is not None:
+        rows = iter_rows(query)
+        for ond, ond_rows in itertools.groupby(rows, key=lambda row: row['ond']):
+            yield ond, flights_batch_store(ond, list(ond_rows), missing, version)
+    for ond in list(missing):
+        yield ond, flights_batch_store(ond, [], missing, version)
+
+
+@app.route('/api/flights/batch', methods=['GET'])
+def get_flights_batch():
+    # /api/flights for several OnDs with the same filters, in one grouped query
+    onds = flights_onds(request.args)
+    error = flights_onds_error(onds)
+    if error is not None:
+        return jsonify(error), 400
+    version = get_watermark()
+    results = flights_batch(request.args, onds, version)
+
+    if request.args.get('stream', 'false').lower() == 'true':
+        # one JSON line per OnD, sent as soon as its results are available
+        def generate():
+            try:
+                for ond, body in results:
+                    yield flights_batch_line(ond, body)
+            except DatabaseUnavailable:
+                yield b'{"error": "Connection to database failed"}\n'
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                yield b'{"error": "Failed to fetch data"}\n'
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+
+    try:
+        bodies = dict(results)
+    except DatabaseUnavailable:
         return jsonify({"error": "Connection to database failed"}), 500
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return jsonify({"error": "Failed to fetch data"}), 500
+    body = b'{' + b', '.join(json.dumps(ond).encode('utf-8') + b': ' + bodies[ond] for ond in onds) + b'}'
+    return json_response(body)
+
+
+def cities_query(prefix=''):
+    # the catalogue is maintained by the writer: one row per OnD instead of a scan of flight_recos
+    query = sql.SQL("SELECT origin, destination FROM ond_catalogue")
+    if prefix:
+        pattern = sql.Literal(prefix + '%')
+        query += sql.SQL(" WHERE origin LIKE {pattern} OR destination LIKE {pattern}").format(pattern=pattern)
+    return query
+
+
+def cities_from_rows(records, prefix=''):
+    origins = set()
+    destinations = set()
+    for record in records:
+        if record['origin'].startswith(prefix):
+            origins.add(record['origin'])
+        if record['destination'].startswith(prefix):
+            destinations.add(record['destination'])
+    return {"origins": sorted(origins), "destinations": sorted(destinations)}
+
+
+def fetch_cities(prefix=''):
+    return cities_from_rows(fetch_rows(cities_query(prefix)), prefix)
+
+
+def cities_prefix(args):
+    # optional prefix of the city codes, for autocompletion
+    return ''.join(c for c in args.get('prefix', '') if c.isalnum()).upper()
+
 
 @app.route('/api/cities', methods=['GET'])
 def get_cities():
-    query = "SELECT DISTINCT OND FROM flight_recos"
-    connection = create_connection()
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            cursor.execute(query)
-            records = cursor.fetchall()
-            origins = set()
-            destinations = set()
-            for record in records:
-                origin, destination = record[0].split('-')
-                origins.add(origin)
-                destinations.add(destination)
-            return jsonify({"origins": sorted(origins), "destinations": sorted(destinations)})
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return jsonify({"error": "Failed to fetch data"}), 500
-        finally:
-            cursor.close()
-            connection.close()
-    else:
+    prefix = cities_prefix(request.args)
+    try:
+        return cached_response(('cities', prefix), lambda: fetch_cities(prefix))
+    except DatabaseUnavailable:
         return jsonify({"error": "Connection to database failed"}), 500
-    
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return jsonify({"error": "Failed to fetch data"}), 500
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Async serving mode unit test, without database nor AWS
+
+> pytest
+
+"""
+
+import asyncio
+import json
+
+import psycopg
+import pytest
+from psycopg2 import sql
+from starlette.testclient import TestClient
+from werkzeug.datastructures import MultiDict
+
+# sets the configuration read when the app is created
+from test_server import FakeDatabase, database, flight, literals, postgres
+
+import asgi
+import server
+
+
+class AsyncDatabase:
+    """
+    Async queries on a FakeDatabase, counting the flights queries running at the same time
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.running = 0
+        self.max_running = 0
+
+    async def fetch_rows(self, query):
+        if query is server.WATERMARK_QUERY:
+            return self.database.fetch_rows(query)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            # lets the other queries start
+            await asyncio.sleep(0.01)
+            if any(isinstance(value, list) for value in literals(query)):
+                return list(self.database.iter_rows(query))
+            return self.database.fetch_rows(query)
+        finally:
+            self.running -= 1
+
+    async def iter_rows(self, query):
+        for row in self.database.iter_rows(query):
+            await asyncio.sleep(0)
+            yield row
+
+
+class FakeAsyncPool:
+    async def open(self, wait):
+        pass
+
+    async def close(self):
+        pass
+
+    def get_stats(self):
+        return {"pool_size": 0}
+
+
+@pytest.fixture
+def async_database(database, monkeypatch):
+    async_database = AsyncDatabase(database)
+    monkeypatch.setattr(asgi, "fetch_rows", async_database.fetch_rows)
+    monkeypatch.setattr(asgi, "iter_rows", async_database.iter_rows)
+    monkeypatch.setattr(asgi, "db_pool", FakeAsyncPool())
+    monkeypatch.setattr(asgi, "DB_MAX_IN_FLIGHT", 2)
+    monkeypatch.setattr(asgi, "watermark", {"version": None})
+    monkeypatch.setattr(server, "WATERMARK_CHECK_INTERVAL", 0.05)
+    return async_database
+
+
+@pytest.fixture
+def client(async_database):
+    # runs the lifespan: flights slots and watermark refresh
+    with TestClient(asgi.app) as client:
+        # first watermark read
+        while asgi.watermark["version"] is None:
+            client.get("/api/pool-stats")
+        yield client
+
+
+def test_to_async_sql(postgres):
+
+    # the same SQL once converted to psycopg 3
+    queries = [
+        server.page_query(sql.SQL("SELECT 1"), ("PAR-LIS' OR TRUE --", 30, "AF"), 10),
+        server.cities_query("PA"),
+        server.WATERMARK_QUERY,
+        sql.SQL("SELECT {} FROM {}").format(sql.Identifier("ond"), sql.Identifier("public", "flights")),
+    ]
+    with psycopg.connect(postgres.dsn) as connection:
+        for query in queries:
+            assert asgi.to_async_sql(query).as_string(connection) == query.as_string(postgres)
+
+        # lists are adapted as arrays by both: same rows
+        with postgres.cursor() as cursor:
+            cursor.execute("CREATE TABLE asgi_flights (ond VARCHAR, adv_purchase INTEGER, main_airline VARCHAR)")
+            cursor.execute("INSERT INTO asgi_flights VALUES ('PAR-LIS', 10, 'AF'), ('NCE-AMS', 5, 'KL'), "
+                           "('LON-NYC', 1, 'BA')")
+        postgres.commit()
+        query = server.page_query(sql.SQL("SELECT * FROM asgi_flights WHERE ond = ANY({})").format(
+            sql.Literal(["PAR-LIS", "NCE-AMS", "MAD-ROM"])), ("NCE-AMS", 5, "KL"), 10)
+        with postgres.cursor() as cursor:
+            cursor.execute(query)
+            rows = cursor.fetchall()
+        assert rows == [("PAR-LIS", 10, "AF")]
+        assert connection.execute(asgi.to_async_sql(query)).fetchall() == rows
+        with postgres.cursor() as cursor:
+            cursor.execute("DROP TABLE asgi_flights")
+        postgres.commit()
+
+
+def test_authentication(client):
+
+    response = client.get("/api/username")
+    assert response.status_code == 401
+    assert response.json() == {"error": "Authentication required"}
+    response = client.get("/api/ond-pairs", headers={"Cookie": "session=forged"})
+    assert response.status_code == 401
+
+
+def test_cached_response(client, database):
+
+    response = client.get("/api/cities?prefix=p")
+    assert response.status_code == 200
+    assert response.json() == {"origins": ["PAR"], "destinations": []}
+    etag = response.headers["ETag"]
+    response = client.get("/api/cities?prefix=p", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert database.queries == 1
+
+
+def test_flights(client, database):
+
+    database.flights = {"PAR-LIS": [flight("PAR-LIS", 10, "TP"), flight("PAR-LIS", 30, "AF")]}
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS")
+    assert response.json() == [flight("PAR-LIS", 30, "AF"), flight("PAR-LIS", 10, "TP")]
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS&limit=1")
+    assert response.json() == {"flights": [flight("PAR-LIS", 30, "AF")], "next": "PAR-LIS,30,AF"}
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS&limit=0")
+    assert response.status_code == 400
+
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS&stream=true")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        flight("PAR-LIS", 30, "AF"), flight("PAR-LIS", 10, "TP")]
+
+
+def test_flights_batch(client, database, async_database, monkeypatch):
+
+    database.flights = {
+        "PAR-LIS": [flight("PAR-LIS", 10, "TP")],
+        "NCE-AMS": [flight("NCE-AMS", 5, "KL")],
+        "LON-NYC": [flight("LON-NYC", 1, "BA")],
+    }
+    response = client.get("/api/flights/batch?filters=false&ond=PARIS")
+    assert response.status_code == 400
+    assert response.json()["invalid"] == ["PARIS"]
+
+    # one query per OnD, at most DB_MAX_IN_FLIGHT at the same time
+    response = client.get("/api/flights/batch?filters=false&ond=PAR-LIS&ond=MAD-ROM&ond=NCE-AMS&ond=LON-NYC")
+    assert response.status_code == 200
+    assert list(response.json()) == ["PAR-LIS", "MAD-ROM", "NCE-AMS", "LON-NYC"]
+    assert response.json()["NCE-AMS"] == [flight("NCE-AMS", 5, "KL")]
+    assert response.json()["MAD-ROM"] == []
+    assert database.queries == 4
+    assert async_database.max_running == 2
+
+    # stream: cached OnDs first
+    response = client.get("/api/flights/batch?filters=false&stream=true&ond=AMS-NCE&ond=LON-NYC")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["ond"] for line in lines] == ["LON-NYC", "AMS-NCE"]
+    assert lines[0]["flights"] == [flight("LON-NYC", 1, "BA")]
+    assert database.queries == 5
+
+    # the failures of the database are reported
+    async def unavailable(query):
+        raise server.DatabaseUnavailable()
+
+    monkeypatch.setattr(asgi, "fetch_rows", unavailable)
+    response = client.get("/api/flights/batch?filters=false&ond=MAD-LIS")
+    assert response.status_code == 500
+    response = client.get("/api/flights/batch?filters=false&stream=true&ond=MAD-LIS")
+    assert response.text == '{"error": "Connection to database failed"}\n'
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""
+Client UI unit test, without database nor AWS
+
+> pytest
+
+"""
+
+import os
+from types import SimpleNamespace
+
+# configuration read when the app is created
+for name in ("AWS_COGNITO_DOMAIN", "AWS_COGNITO_USER_POOL_ID", "AWS_COGNITO_USER_POOL_CLIENT_ID",
+             "AWS_COGNITO_USER_POOL_CLIENT_SECRET", "AWS_COGNITO_REDIRECT_URL", "AWS_COGNITO_LOGOUT_URL"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("AWS_REGION", "eu-west-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("SECRET_KEY", "test")
+# DynamoDB is mocked with moto
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+
+import json
+
+import psycopg2
+import pytest
+from botocore.exceptions import ClientError
+from psycopg2 import sql
+from psycopg2.pool import PoolError
+from werkzeug.datastructures import MultiDict
+
+try:
+    # imported before the app creates its DynamoDB client, so that moto can mock it
+    import moto
+except ImportError:
+    moto = None
+
+import server
+
+
+class FakeClock:
+    # replaces the time module of the server
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeDatabase:
+    """
+    Rows returned for the queries of the server, and data version of the writer
+    """
+
+    def __init__(self):
+        self.version = 1
+        self.cities = [{"origin": "PAR", "destination": "LIS"}, {"origin": "NCE", "destination": "AMS"}]
+        # rows of the flights queries per OnD
+        self.flights = {}
+        self.queries = 0
+
+    def fetch_rows(self, query):
+        if query is server.WATERMARK_QUERY:
+            if self.version is None:
+                raise server.DatabaseUnavailable()
+            return [{"version": self.version}]
+        self.queries += 1
+        return self.cities
+
+    def iter_rows(self, query):
+        # rows of the OnDs of "ond = ANY(...)", in the order of the query
+        self.queries += 1
+        onds = next(value for value in literals(query) if isinstance(value, list))
+        for ond in sorted(onds):
+            yield from sorted(self.flights.get(ond, []),
+                              key=lambda row: (-row["adv_purchase"], row["main_airline"]))
+
+
+def literals(query):
+    if isinstance(query, sql.Literal):
+        yield query.wrapped
+    elif isinstance(query, sql.Composed):
+        for part in query.seq:
+            yield from literals(part)
+
+
+def flight(ond, adv_purchase, main_airline, median_price=100.0):
+    return {"median_price": median_price, "adv_purchase": adv_purchase, "main_airline": main_airline, "ond": ond}
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "fetch_rows", database.fetch_rows)
+    monkeypatch.setattr(server, "iter_rows", database.iter_rows)
+    monkeypatch.setattr(server, "result_cache", server.ResultCache(100, 300))
+    monkeypatch.setattr(server, "WATERMARK_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(server, "watermark", {"version": None, "checked": None})
+    return database
+
+
+@pytest.fixture(scope="module")
+def postgres(tmp_path_factory):
+    # throwaway PostgreSQL server, for the tests of the SQL itself
+    pgserver = pytest.importorskip("pgserver")
+    database = pgserver.get_server(tmp_path_factory.mktemp("pgdata"), cleanup_mode="stop")
+    connection = psycopg2.connect(database.get_uri())
+    yield connection
+    connection.close()
+    database.cleanup()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "time", clock)
+    return clock
+
+
+class FakeConnection:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        if not self.connection.healthy:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeThreadedPool:
+    # idle connections are given back first, new ones are healthy
+    def __init__(self, minconn, maxconn, **connect_kwargs):
+        self.idle = []
+        self.created = 0
+
+    def getconn(self):
+        if self.idle:
+            return self.idle.pop()
+        self.created += 1
+        return FakeConnection()
+
+    def putconn(self, connection, close=False):
+        if close:
+            connection.closed = 1
+        else:
+            self.idle.append(connection)
+
+
+def test_pool_discards_broken_connections(monkeypatch):
+
+    monkeypatch.setattr(server, "ThreadedConnectionPool", FakeThreadedPool)
+    pool = server.ConnectionPool(1, 3, timeout=0.1, check_interval=0)
+    connections = [pool.getconn() for _ in range(3)]
+    for connection in connections:
+        pool.putconn(connection)
+    # the database restarted: all the idle connections are broken
+    for connection in connections:
+        connection.healthy = False
+
+    connection = pool.getconn()
+    assert connection not in connections and connection.healthy
+    assert pool.stats()["discarded"] == 3
+    assert all(connection.closed for connection in connections)
+    pool.putconn(connection)
+    assert pool.stats()["in_use"] == 0
+
+    # bounded number of checks
+    monkeypatch.setattr(FakeThreadedPool, "getconn", lambda self: FakeConnection(healthy=False))
+    pool.last_used = {}
+    monkeypatch.setattr(pool, "is_healthy", lambda connection: connection.healthy)
+    with pytest.raises(PoolError):
+        pool.getconn()
+    assert pool.stats()["in_use"] == 0
+    # the slot is released
+    assert pool.slots.acquire(blocking=False)
+
+
+def test_result_cache(clock):
+
+    cache = server.ResultCache(2, ttl=10)
+    assert cache.get("a", 1) is None
+    cache.put("a", 1, b"A")
+    assert cache.get("a", 1) == b"A"
+
+    # new data loaded by the writer
+    assert cache.get("a", 2) is None
+    assert cache.get("a", 1) is None
+
+    cache.put("a", 1, b"A")
+    clock.now += 11
+    assert cache.get("a", 1) is None
+
+    # least recently used first out
+    cache.put("a", 1, b"A")
+    cache.put("b", 1, b"B")
+    cache.get("a", 1)
+    cache.put("c", 1, b"C")
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == b"A"
+    assert cache.stats() == {"hits": 3, "misses": 3, "expired": 1, "stale": 1, "evictions": 1,
+                             "size": 2, "max_size": 2}
+
+
+def test_cached_response(database):
+
+    client = server.app.test_client()
+    response = client.get("/api/cities")
+    assert response.status_code == 200
+    assert response.json == {"origins": ["NCE", "PAR"], "destinations": ["AMS", "LIS"]}
+    assert database.queries == 1
+
+    # cache key: the prefix
+    assert client.get("/api/cities").json == response.json
+    assert database.queries == 1
+    assert client.get("/api/cities?prefix=p").json == {"origins": ["PAR"], "destinations": []}
+    assert client.get("/api/cities?prefix=P-").json == {"origins": ["PAR"], "destinations": []}
+    assert database.queries == 2
+
+    # browser revalidation
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+    response = client.get("/api/cities", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.data == b""
+    assert database.queries == 2
+
+    # invalidated on ingest
+    database.cities.append({"origin": "PAR", "destination": "NYC"})
+    database.version = 2
+    response = client.get("/api/cities", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["destinations"] == ["AMS", "LIS", "NYC"]
+    assert response.headers["ETag"] != etag
+    assert database.queries == 3
+    assert server.result_cache.stats()["stale"] == 1
+
+
+def test_watermark(database, clock, monkeypatch):
+
+    monkeypatch.setattr(server, "WATERMARK_CHECK_INTERVAL", 5)
+    client = server.app.test_client()
+    client.get("/api/cities")
+
+    # new data seen after the check interval only
+    database.version = 2
+    clock.now += 1
+    client.get("/api/cities")
+    assert database.queries == 1
+    clock.now += 5
+    client.get("/api/cities")
+    assert database.queries == 2
+
+    # no watermark: the entries expire with the TTL
+    database.version = None
+    clock.now += 5
+    client.get("/api/cities")
+    client.get("/api/cities")
+    assert database.queries == 3
+    clock.now += 301
+    client.get("/api/cities")
+    assert database.queries == 4
+
+
+def test_flights_batch_validation(database, monkeypatch):
+
+    monkeypatch.setattr(server, "FLIGHTS_BATCH_MAX_ONDS", 3)
+    client = server.app.test_client()
+    response = client.get("/api/flights/batch?filters=false")
+    assert response.status_code == 400
+    response = client.get("/api/flights/batch?filters=false&ond=PAR-LIS&ond=NCE-AMS&ond=LON-NYC&ond=MAD-ROM")
+    assert response.status_code == 400
+    assert response.json["error"] == "Between 1 and 3 OnDs are required"
+    # duplicates count once
+    response = client.get("/api/flights/batch?filters=false&ond=PAR-LIS&ond=NCE-AMS&ond=LON-NYC&ond= par-lis ")
+    assert response.status_code == 200
+
+    # each invalid OnD is reported
+    response = client.get("/api/flights/batch?filters=false&ond=PAR-LIS&ond=PARIS&ond=NCE-AMS'")
+    assert response.status_code == 400
+    assert response.json["invalid"] == ["PARIS", "NCE-AMS'"]
+    assert database.queries == 1
+
+
+def test_flights_batch(database):
+
+    database.flights = {
+        "PAR-LIS": [flight("PAR-LIS", 10, "TP"), flight("PAR-LIS", 30, "AF")],
+        "NCE-AMS": [flight("NCE-AMS", 5, "KL")],
+        "LON-NYC": [flight("LON-NYC", 1, "BA")],
+    }
+    client = server.app.test_client()
+
+    # keyed by OnD in the order of the request, OnDs without results get an empty list
+    response = client.get("/api/flights/batch?filters=false&ond=PAR-LIS&ond=MAD-ROM&ond=NCE-AMS")
+    assert response.status_code == 200
+    assert list(response.json) == ["PAR-LIS", "MAD-ROM", "NCE-AMS"]
+    assert response.json["PAR-LIS"] == [flight("PAR-LIS", 30, "AF"), flight("PAR-LIS", 10, "TP")]
+    assert response.json["MAD-ROM"] == []
+    assert database.queries == 1
+
+    # results shared with /api/flights
+    response = client.get("/api/flights?filters=false&origin=NCE&destination=AMS")
+    assert response.json == [flight("NCE-AMS", 5, "KL")]
+    assert database.queries == 1
+
+    # stream: cached OnDs first, then the queried ones as their rows are read, those without rows last
+    response = client.get("/api/flights/batch?filters=false&stream=true&ond=LON-NYC&ond=PAR-LIS&ond=AMS-NCE")
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert [line["ond"] for line in lines] == ["PAR-LIS", "LON-NYC", "AMS-NCE"]
+    assert lines[1]["flights"] == [flight("LON-NYC", 1, "BA")]
+    assert lines[2]["flights"] == []
+    assert database.queries == 2
+
+
+def test_flights_page():
+
+    assert server.flights_page(MultiDict()) == (None, None)
+    assert server.flights_page(MultiDict({"limit": "10"})) == (None, 10)
+    assert server.flights_page(MultiDict({"after": "PAR-LIS,30,AF"})) == (("PAR-LIS", 30, "AF"), server.FLIGHTS_PAGE_MAX)
+    for args in (dict(limit="0"), dict(limit=str(server.FLIGHTS_PAGE_MAX + 1)),
+                 dict(after="PAR-LIS,30"), dict(after="PAR-LIS,AF,30"), dict(after="PAR-LIS,30,AF,KL")):
+        with pytest.raises(ValueError):
+            server.flights_page(MultiDict(args))
+
+    # cursor values only reach the query as literals
+    after = ("PAR-LIS' OR TRUE --", 30, "AF")
+    values = list(literals(server.page_query(sql.SQL("SELECT 1"), after, 10)))
+    assert values == ["PAR-LIS' OR TRUE --", -30, "AF", 10]
+
+    # next page: cursor of the last row, None on the last page
+    rows = [flight("PAR-LIS", 30, "AF"), flight("PAR-LIS", 30, "KL"), flight("PAR-LIS", 10, "AF")]
+    assert server.page_result(rows, 2) == {"flights": rows[:2], "next": "PAR-LIS,30,KL"}
+    assert server.page_result(rows, 3) == {"flights": rows, "next": None}
+
+
+def test_flights_page_request(database):
+
+    client = server.app.test_client()
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS&after=PAR-LIS,x,AF")
+    assert response.status_code == 400
+    response = client.get("/api/flights?filters=false&origin=PAR&destination=LIS&limit=-1")
+    assert response.status_code == 400
+    assert database.queries == 0
+
+
+def test_page_query(postgres):
+
+    with postgres.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMPORARY TABLE flights_results (
+                median_price FLOAT, adv_purchase INTEGER, main_airline VARCHAR, ond VARCHAR)
+        """)
+        # many rows with the same OnD and advance purchase: pages end between them
+        rows = [(100.0 + i, adv_purchase, airline, ond)
+                for i, (ond, adv_purchase, airline) in enumerate(
+                    (ond, adv_purchase, airline)
+                    for ond in ("NCE-AMS", "PAR-LIS")
+                    for adv_purchase in (1, 10, 30)
+                    for airline in ("AF", "KL", "TP", "U2"))]
+        cursor.executemany("INSERT INTO flights_results VALUES (%s, %s, %s, %s)", rows)
+    query = sql.SQL("SELECT median_price, adv_purchase, main_airline, ond FROM flights_results")
+
+    def fetch(query):
+        with postgres.cursor() as cursor:
+            cursor.execute(query)
+            columns = [desc[0] for desc in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    everything = fetch(server.page_query(query))
+    assert len(everything) == 24
+    assert [row["ond"] for row in everything[:12]] == ["NCE-AMS"] * 12
+    assert [row["adv_purchase"] for row in everything[:5]] == [30, 30, 30, 30, 10]
+
+    # pages hold the rows in the same order, once, whatever the limit
+    for limit in (1, 3, 5, 24, 25):
+        pages = []
+        after = None
+        while True:
+            page = server.page_result(fetch(server.page_query(query, after, limit + 1)), limit)
+            pages.append(page["flights"])
+            if page["next"] is None:
+                break
+            after = server.flights_page(MultiDict({"after": page["next"]}))[0]
+        assert [row for page in pages for row in page] == everything
+        assert len(pages) == max(1, -(-24 // limit))
+        assert 0 < len(pages[-1]) <= limit
+
+    # a cursor past the last row: empty last page
+    page = server.page_result(fetch(server.page_query(query, ("PAR-LIS", 1, "U2"), 11)), 10)
+    assert page == {"flights": [], "next": None}
+
+
+def test_fetch_ond_pairs(clock, monkeypatch):
+
+    if moto is None:
+        pytest.skip("moto is not installed")
+    monkeypatch.setattr(server, "ond_pairs_cache", {})
+    with moto.mock_aws(), server.app.app_context():
+        server.dynamo.create_all()
+        table = server.dynamo.tables["AirlineOnDPairs"]
+        table.put_item(Item={"username": "ALICE", "pairs": ["PAR-LIS"]})
+        events = table.meta.client.meta.events
+        reads = []
+        events.register("before-call.dynamodb.GetItem", lambda params, **kwargs: reads.append(params["body"]))
+
+        assert server.fetch_ond_pairs("alice") == {"username": "ALICE", "pairs": ["PAR-LIS"]}
+        assert server.fetch_ond_pairs("Alice")["pairs"] == ["PAR-LIS"]
+        assert len(reads) == 1
+        assert server.fetch_ond_pairs("bob") == {}
+
+        # read again after the TTL, or on refresh
+        table.put_item(Item={"username": "ALICE", "pairs": ["PAR-LIS", "NCE-AMS"]})
+        clock.now += server.OND_PAIRS_CACHE_TTL - 1
+        assert server.fetch_ond_pairs("alice")["pairs"] == ["PAR-LIS"]
+        clock.now += 2
+        assert server.fetch_ond_pairs("alice")["pairs"] == ["PAR-LIS", "NCE-AMS"]
+        table.put_item(Item={"username": "ALICE", "pairs": ["NCE-AMS"]})
+        assert server.fetch_ond_pairs("alice", refresh=True)["pairs"] == ["NCE-AMS"]
+        assert len(reads) == 4
+
+        # throttled: the pairs read before
+        def throttle(**kwargs):
+            error = {"Code": "ProvisionedThroughputExceededException", "Message": "Rate exceeded"}
+            return SimpleNamespace(status_code=400), {"Error": error}
+        events.register("before-call.dynamodb.GetItem", throttle, unique_id="throttle")
+        assert server.fetch_ond_pairs("alice", refresh=True)["pairs"] == ["NCE-AMS"]
+        clock.now += server.OND_PAIRS_CACHE_TTL + 1
+        assert server.fetch_ond_pairs("alice")["pairs"] == ["NCE-AMS"]
+        assert len(reads) == 6
+        # nothing read before
+        with pytest.raises(ClientError):
+            server.fetch_ond_pairs("carol")
+        events.unregister("before-call.dynamodb.GetItem", unique_id="throttle")
+
+        # other errors are not hidden
+        table.delete()
+        with pytest.raises(ClientError) as error:
+            server.fetch_ond_pairs("alice", refresh=True)
+        assert error.value.response["Error"]["Code"] == "ResourceNotFoundException"
@@ -0,0 +1,151 @@
+"""
+Compact binary encoding of decorated searches.
+
+Field names are not repeated for every reco and flight: a search is turned into
+nested arrays following SEARCH_SCHEMA (values only, in schema order), then packed
+with MessagePack. Decoding rebuilds the same dicts, with the same key order, as
+recoReader.group_and_decorate.
+
+The schema follows recoReader._RECO_LAYOUT and _FLIGHT_LAYOUT plus the decoration
+fields: any change there must come with a new SCHEMA_VERSION.
+
+"""
+
+import struct
+
+import msgpack
+
+SCHEMA_VERSION = 1
+
+# schema entries: (field name, None) for a scalar, (field name, schema) for a list of dicts
+FLIGHT_SCHEMA = [
+    ("dep_airport", None),
+    ("dep_date", None),
+    ("dep_time", None),
+    ("arr_airport", None),
+    ("arr_date", None),
+    ("arr_time", None),
+    ("operating_airline", None),
+    ("marketing_airline", None),
+    ("flight_nb", None),
+    ("cabin", None),
+    # decoration
+    ("dep_city", None),
+    ("arr_city", None),
+    ("distance", None),
+]
+
+RECO_SCHEMA = [
+    ("price", None),
+    ("taxes", None),
+    ("fees", None),
+    ("nb_of_flights", None),
+    ("flights", FLIGHT_SCHEMA),
+    # decoration
+    ("price_EUR", None),
+    ("taxes_EUR", None),
+    ("fees_EUR", None),
+    ("flown_distance", None),
+    ("main_marketing_airline", None),
+    ("main_operating_airline", None),
+    ("main_cabin", None),
+]
+
+PASSENGER_SCHEMA = [
+    ("passenger_type", None),
+    ("passenger_nb", None),
+]
+
+SEARCH_SCHEMA = [
+    ("version_nb", None),
+    ("search_id", None),
+    ("search_country", None),
+    ("search_date", None),
+    ("search_time", None),
+    ("origin_city", None),
+    ("destination_city", None),
+    ("request_dep_date", None),
+    ("request_return_date", None),
+    ("passengers_string", None),
+    ("currency", None),
+    ("recos", RECO_SCHEMA),
+    # decoration
+    ("advance_purchase", None),
+    ("stay_duration", None),
+    ("trip_type", None),
+    ("passengers", PASSENGER_SCHEMA),
+    ("origin_country", None),
+    ("destination_country", None),
+    ("geo", None),
+    ("OnD", None),
+    ("OnD_distance", None),
+]
+
+# file framing: each encoded search is prefixed by its length
+_FRAME_HEADER = struct.Struct("<I")
+
+
+def _to_arrays(record, schema):
+    return [
+        record[name]
+        if sub_schema is None
+        else [_to_arrays(item, sub_schema) for item in record[name]]
+        for name, sub_schema in schema
+    ]
+
+
+def _from_arrays(values, schema):
+    return {
+        name: value
+        if sub_schema is None
+        else [_from_arrays(item, sub_schema) for item in value]
+        for value, (name, sub_schema) in zip(values, schema)
+    }
+
+
+def encode(search):
+    """
+    :param search: decorated search dict
+    :return: bytes
+    """
+    return msgpack.packb([SCHEMA_VERSION, _to_arrays(search, SEARCH_SCHEMA)])
+
+
+def decode(data):
+    """
+    :param data: bytes written by encode
+    :return search: decorated search dict
+    """
+    version, values = msgpack.unpackb(data)
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported compact schema version: {version}")
+    return _from_arrays(values, SEARCH_SCHEMA)
+
+
+def is_compact(data):
+    """
+    Tells compact messages from json ones (json searches start with "{")
+    :param data: bytes
+    """
+    return data[:1] != b"{"
+
+
+def write_frame(stream, data):
+    stream.write(_FRAME_HEADER.pack(len(data)))
+    stream.write(data)
+
+
+def read_frames(stream):
+    """
+    :param stream: binary stream with length prefixed encoded searches
+    :return: iterator on encoded searches
+    """
+    while True:
+        header = stream.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return
+        (size,) = _FRAME_HEADER.unpack(header)
+        data = stream.read(size)
+        if len(data) < size:
+            raise ValueError(f"Truncated frame: {len(data)} bytes out of {size}")
+        yield data
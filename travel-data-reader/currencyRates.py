@@ -0,0 +1,196 @@
+"""
+Euro reference rates indexed by date, reloaded when the rates file changes.
+
+Reads the files published by the ECB: the daily one (eurofxref.csv, one line of
+rates) as well as the full history (eurofxref-hist.csv, one line per business day
+since 1999). The rates of a currency are kept in an array with one slot per calendar
+day from the first date of the file, so that the rate of a search is read by index
+from its search_date. Days without rates (week-ends, holidays) hold the rate of the
+previous business day, dates out of the file range use the first or last rates.
+
+A RateStore serves the current RateTable and, when watching, reloads the file in a
+daemon thread: a new table is built aside then swapped, readers always see a
+complete table.
+
+"""
+
+import array
+import datetime
+import logging
+import math
+import os
+import threading
+import time
+
+import isoDates
+
+logger = logging.getLogger()
+
+# seconds between two checks of the rates file, 0 disables the reload
+RATES_RELOAD_INTERVAL = float(os.getenv("RATES_RELOAD_INTERVAL", 300))
+
+
+def _parse_date(value):
+    # history file: 2021-11-19, daily file: 19 November 2021
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        return datetime.datetime.strptime(value, "%d %B %Y").date()
+
+
+def _parse_rate(value):
+    # currencies not quoted yet, or not anymore, are N/A in the history file
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+class RateTable:
+    """
+    Rates of each currency, one per calendar day
+    """
+
+    def __init__(self, days):
+        """
+        :param days: dict date -> dict currency code -> rate (nan when unknown)
+        """
+        self.first_date = min(days)
+        self.last_date = max(days)
+        self._first_ordinal = self.first_date.toordinal()
+        self._last_index = self.last_date.toordinal() - self._first_ordinal
+        currencies = sorted({currency for rates in days.values() for currency in rates})
+        self.rates = {}
+        for currency in currencies:
+            values = array.array("d", [math.nan]) * (self._last_index + 1)
+            for rate_date, rates in days.items():
+                values[rate_date.toordinal() - self._first_ordinal] = rates.get(
+                    currency, math.nan
+                )
+            # days without rates get the previous ones, the oldest days the first ones
+            last = next((value for value in values if not math.isnan(value)), math.nan)
+            for i, value in enumerate(values):
+                if math.isnan(value):
+                    values[i] = last
+                else:
+                    last = value
+            self.rates[currency] = values
+
+    def index(self, date_string):
+        """
+        :param date_string: date as YYYY-MM-DD
+        :return: index of the date in the rate arrays, clamped to the file range
+        """
+        i = isoDates.day_number(date_string) - self._first_ordinal
+        return 0 if i < 0 else self._last_index if i > self._last_index else i
+
+    def rate(self, currency, date_string):
+        """
+        :param currency: 3-letter currency code
+        :param date_string: date as YYYY-MM-DD
+        :return: amount of the currency for one euro at that date
+        """
+        if currency == "EUR":
+            return 1.0
+        value = self.rates[currency][self.index(date_string)]
+        if math.isnan(value):
+            raise KeyError(f"No {currency} rate")
+        return value
+
+    def latest(self):
+        """
+        :return: dict currency code -> rate of the last date
+        """
+        return {
+            currency: values[-1]
+            for currency, values in self.rates.items()
+            if not math.isnan(values[-1])
+        }
+
+
+def read_table(rates_file):
+    """
+    :param rates_file: name of an ECB rates CSV file, daily or history
+    :return: RateTable
+    """
+    header = None
+    days = {}
+    with open(rates_file, "r") as f:
+        for line in f:
+            # trailing commas give empty fields
+            fields = [x.strip() for x in line.rstrip().split(",")]
+            if len(fields) <= 1:
+                continue  # skip empty line
+            if header is None:
+                # first line is the header: Date, USD, JPY, BGN, CZK, DKK, ...
+                header = fields
+                continue
+            days[_parse_date(fields[0])] = {
+                currency: _parse_rate(value)
+                for currency, value in zip(header[1:], fields[1:])
+                if currency != ""
+            }
+    if not days:
+        raise ValueError(f"No rates in {rates_file}")
+    return RateTable(days)
+
+
+class RateStore:
+    """
+    Current rates of a file, reloaded in the background when the file changes
+    """
+
+    def __init__(self, rates_file, reload_interval=RATES_RELOAD_INTERVAL):
+        """
+        :param rates_file: name of an ECB rates CSV file, daily or history
+        :param reload_interval: seconds between two checks of the file, 0 never reloads
+        """
+        self.rates_file = rates_file
+        self.reload_interval = reload_interval
+        self._mtime = os.stat(rates_file).st_mtime_ns
+        self.table = read_table(rates_file)
+        # process running the reload thread: forked workers do not inherit the thread
+        self._watching_pid = None
+
+    def rate(self, currency, date_string):
+        """
+        :param currency: 3-letter currency code
+        :param date_string: date as YYYY-MM-DD
+        :return: amount of the currency for one euro at that date
+        """
+        return self.table.rate(currency, date_string)
+
+    def reload(self):
+        """
+        Reads the file again if it changed since the last load
+        :return: whether a new table was loaded
+        """
+        mtime = os.stat(self.rates_file).st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        table = read_table(self.rates_file)
+        # a single assignment: decorations in progress keep the table they read
+        self.table = table
+        self._mtime = mtime
+        logger.info(
+            "Currency rates reloaded: %s to %s" % (table.first_date, table.last_date)
+        )
+        return True
+
+    def watch(self):
+        """
+        Starts the reload thread of this process, if reloading is enabled
+        """
+        if self.reload_interval <= 0 or self._watching_pid == os.getpid():
+            return
+        self._watching_pid = os.getpid()
+        threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception:
+                # a file being rewritten is read again at the next check
+                logger.exception("Failed at reloading currency rates")
@@ -1,30 +1,110 @@
 #!/usr/bin/env python3
-from datetime import datetime
+from datetime import date
 from confluent_kafka import Consumer, KafkaError
-import json
+from collections import Counter
+import csv
+import io
+import math
 import os
+import time
+import jsonCodec
+import compactCodec
+import isoDates
+import metrics
 import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
 
 PG_HOST = os.getenv("PG_HOST", "localhost")
 PG_PORT = os.getenv("PG_PORT", "5432")
 PG_DATABASE = os.getenv("PG_DATABASE", "flightdb")
 PG_USER = os.getenv("PG_USER", "postgres")
 PG_PASSWORD = os.getenv("PG_PASSWORD")
-PG_TABLE = os.getenv("PG_TABLE", "flight-recos")
+PG_TABLE = os.getenv("PG_TABLE", "flight_recos")
+PG_ROLLUP_TABLE = os.getenv("PG_ROLLUP_TABLE", "flight_recos_rollup")
+# Catalogue of the OnDs met in the data, for the client UI
+PG_OND_TABLE = os.getenv("PG_OND_TABLE", "ond_catalogue")
+# Version of the data, bumped at each load: readers use it to invalidate their caches
+PG_WATERMARK_TABLE = os.getenv("PG_WATERMARK_TABLE", "ingest_watermark")
+# The table is partitioned by month of search_time: partitions are created for the
+# months met in the data, and PG_PARTITIONS_AHEAD months ahead of the current one
+PG_PARTITIONS_AHEAD = int(os.getenv("PG_PARTITIONS_AHEAD", 3))
 
 KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092")
 KAFKA_TOPIC = os.getenv("KAFKA_TOPIC", "decorated-recos")
 
-consumer_conf = {
-    "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
-    "group.id": "reco-writers",
-    "auto.offset.reset": "earliest",
-}
-consumer = Consumer(consumer_conf)
-consumer.subscribe([KAFKA_TOPIC])
+# Rows are buffered and loaded when WRITER_BATCH_ROWS rows are buffered or
+# WRITER_FLUSH_INTERVAL seconds have passed since the last load
+WRITER_BATCH_ROWS = int(os.getenv("WRITER_BATCH_ROWS", 5000))
+WRITER_FLUSH_INTERVAL = float(os.getenv("WRITER_FLUSH_INTERVAL", 5))
+
+# Rollup: number of searches per min price bin. Bins are log scaled, each one is
+# ROLLUP_BIN_RATIO times wider than the previous one (about 1.5% error on the median)
+ROLLUP_BIN_RATIO = float(os.getenv("ROLLUP_BIN_RATIO", 1.03))
+_ROLLUP_ALL_CABINS = "*"
+# bin of the free (or negative) prices, below the bins of all positive prices
+_ROLLUP_FREE_BIN = -(2**31)
+
+# Port of the metrics endpoint (Prometheus format), 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9102))
+
+_COLUMNS = [
+    "search_id",
+    "search_country",
+    "OnD",
+    "trip_type",
+    "main_airline",
+    "price_EUR",
+    "advance_purchase",
+    "number_of_flights",
+    "search_time",
+    "passengers",
+    "cabin",
+    "stay_duration",
+]
+
+# Metrics
+stage_seconds = metrics.Histogram(
+    "writer_stage_seconds",
+    "Time spent per stage: consume (per message), decode and rows (per search), "
+    "flush (per database load)",
+    "stage",
+)
+buffered_rows = metrics.Gauge(
+    "writer_buffered_rows", "Rows waiting for the next database load", "buffer"
+)
+consumer_lag = metrics.Gauge(
+    "writer_consumer_lag",
+    "Messages not consumed yet, per partition, as of the last load",
+    "partition",
+)
+# messages, rows_loaded, flushes, kafka_errors, flush_errors
+stats = Counter()
+events = metrics.Collected(
+    "writer_events_total", "Messages consumed, rows loaded and errors", "event"
+)
+events.track("writer", stats)
+
+
+def create_consumer():
+    # offsets are committed once the rows are committed in the database
+    consumer_conf = {
+        "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
+        "group.id": "reco-writers",
+        "auto.offset.reset": "earliest",
+        "enable.auto.commit": False,
+    }
+    consumer = Consumer(consumer_conf)
+    consumer.subscribe([KAFKA_TOPIC])
+    return consumer
 
 
 def create_table(cursor):
+    """
+    Creates the table, partitioned by range of search_time, and its indexes
+    :param cursor: psycopg2 cursor
+    :return partitioned: False if the table already exists without partitions
+    """
     create_table_sql = f"""
         CREATE TABLE IF NOT EXISTS {PG_TABLE} (
             search_id VARCHAR,
@@ -39,97 +119,476 @@ def create_table(cursor):
             passengers VARCHAR,
             cabin VARCHAR,
             stay_duration INTEGER
+        ) PARTITION BY RANGE (search_time)
+    """
+    cursor.execute(create_table_sql)
+
+    # /api/flights always filters on OnD, then on trip type, cabin and search time.
+    # The other columns it reads are included so that it can be answered from the index.
+    cursor.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {PG_TABLE}_flights_idx
+        ON {PG_TABLE} (OnD, trip_type, cabin, search_time)
+        INCLUDE (stay_duration, number_of_flights, advance_purchase, main_airline, price_EUR, search_id)
+        """
+    )
+
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (PG_TABLE,)
+    )
+    partitioned = cursor.fetchone()[0] == "p"
+    if not partitioned:
+        print(f"Table {PG_TABLE} is not partitioned: no partition will be created")
+    return partitioned
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_months(rows, today=None):
+    """
+    :param rows: list of tuples in _COLUMNS order
+    :param today: date of the current month (default: today)
+    :return months: set of first days of the months needed by the rows and the months ahead
+    """
+    search_time_index = _COLUMNS.index("search_time")
+    months = {month_start(row[search_time_index]) for row in rows}
+    month = month_start(today or date.today())
+    for _ in range(PG_PARTITIONS_AHEAD + 1):
+        months.add(month)
+        month = next_month(month)
+    return months
+
+
+# months whose partition is known to exist
+_partitions = set()
+
+
+def create_partitions(conn, months):
+    """
+    Creates the missing monthly partitions, each one in its own transaction so that
+    a partition created at the same time by another writer does not fail the load
+    :param conn: psycopg2 connection
+    :param months: set of first days of months
+    """
+    for month in sorted(months - _partitions):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {PG_TABLE}_{month:%Y_%m}
+                    PARTITION OF {PG_TABLE} FOR VALUES FROM (%s) TO (%s)
+                    """,
+                    (month, next_month(month)),
+                )
+            conn.commit()
+        except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+            conn.rollback()
+        _partitions.add(month)
+
+
+def create_rollup_table(cursor):
+    """
+    Creates the rollup table, filled from the existing rows when it is created
+    :param cursor: psycopg2 cursor
+    """
+    # one row per bucket and price bin: number of searches whose min price is in the bin.
+    # bin_price is the geometric center of the bin, cabin "*" is the min over all cabins
+    cursor.execute("SELECT to_regclass(%s)", (PG_ROLLUP_TABLE,))
+    exists = cursor.fetchone()[0] is not None
+    create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {PG_ROLLUP_TABLE} (
+            OnD VARCHAR,
+            main_airline VARCHAR,
+            advance_purchase INTEGER,
+            trip_type VARCHAR,
+            cabin VARCHAR,
+            day DATE,
+            price_bin INTEGER,
+            bin_price FLOAT,
+            searches INTEGER,
+            PRIMARY KEY (OnD, main_airline, advance_purchase, trip_type, cabin, day, price_bin)
         )
     """
     cursor.execute(create_table_sql)
+    if not exists:
+        # same bins as price_bin, on the min prices computed like rollup_counts
+        cursor.execute(
+            f"""
+            INSERT INTO {PG_ROLLUP_TABLE} (OnD, main_airline, advance_purchase, trip_type,
+                                           cabin, day, price_bin, bin_price, searches)
+            SELECT OnD, main_airline, advance_purchase, trip_type, cabin, day, price_bin,
+                   CASE WHEN price_bin = %(free_bin)s THEN 0.0
+                        ELSE POWER(%(ratio)s, price_bin + 0.5) END,
+                   COUNT(*)
+            FROM (
+                SELECT OnD, main_airline, advance_purchase, trip_type, cabin, day,
+                       CASE WHEN min_price <= 0 THEN %(free_bin)s
+                            ELSE FLOOR(LN(min_price) / LN(%(ratio)s)) END AS price_bin
+                FROM (
+                    SELECT search_id, OnD, main_airline, advance_purchase, trip_type,
+                           CASE WHEN GROUPING(cabin) = 1 THEN %(all_cabins)s
+                                ELSE cabin END AS cabin,
+                           search_time::date AS day, MIN(price_EUR) AS min_price
+                    FROM {PG_TABLE}
+                    GROUP BY GROUPING SETS (
+                        (search_id, OnD, main_airline, advance_purchase, trip_type,
+                         cabin, search_time::date),
+                        (search_id, OnD, main_airline, advance_purchase, trip_type,
+                         search_time::date)
+                    )
+                ) AS min_prices
+            ) AS bins
+            GROUP BY OnD, main_airline, advance_purchase, trip_type, cabin, day, price_bin
+            """,
+            {
+                "ratio": ROLLUP_BIN_RATIO,
+                "free_bin": _ROLLUP_FREE_BIN,
+                "all_cabins": _ROLLUP_ALL_CABINS,
+            },
+        )
 
 
-def populate_postgres_from_kafka():
-    try:
-        print("Consumer started")
-        conn = psycopg2.connect(
-            host=PG_HOST,
-            port=PG_PORT,
-            dbname=PG_DATABASE,
-            user=PG_USER,
-            password=PG_PASSWORD,
+def create_ond_table(cursor):
+    """
+    Creates the OnD catalogue, filled from the existing rows when it is created
+    :param cursor: psycopg2 cursor
+    """
+    cursor.execute("SELECT to_regclass(%s)", (PG_OND_TABLE,))
+    exists = cursor.fetchone()[0] is not None
+    create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {PG_OND_TABLE} (
+            OnD VARCHAR PRIMARY KEY,
+            origin VARCHAR,
+            destination VARCHAR,
+            first_seen TIMESTAMP,
+            last_seen TIMESTAMP,
+            row_count BIGINT
+        )
+    """
+    cursor.execute(create_table_sql)
+    if not exists:
+        cursor.execute(
+            f"""
+            INSERT INTO {PG_OND_TABLE} (OnD, origin, destination, first_seen, last_seen, row_count)
+            SELECT OnD, split_part(OnD, '-', 1), split_part(OnD, '-', 2),
+                   MIN(search_time), MAX(search_time), COUNT(*)
+            FROM {PG_TABLE}
+            GROUP BY OnD
+            """
         )
-        cursor = conn.cursor()
 
-        create_table(cursor)
 
-        while True:
-            msg = consumer.poll(timeout=1.0)
-            if msg is None:
-                continue
-            if msg.error():
-                if msg.error().code() == KafkaError._PARTITION_EOF:
-                    print(
-                        f"Consumer reached end of partition {msg.topic()} [{msg.partition()}]"
-                    )
-                elif msg.error():
-                    print(f"Error: {msg.error()}")
-                continue
-
-            json_data = json.loads(msg.value().decode("utf-8"))
-            print("loaded: ", json_data)
-
-            search_id = json_data["search_id"]
-            search_country = json_data["search_country"]
-            OnD = json_data["OnD"]
-            trip_type = json_data["trip_type"]
-            search_date = json_data["search_date"]
-            search_time = json_data["search_time"]
-            timestamp = datetime.strptime(
-                search_date + "T" + search_time, "%Y-%m-%dT%H:%M:%S"
+def ond_summary(rows):
+    """
+    :param rows: list of tuples in _COLUMNS order
+    :return onds: dict OnD -> (first seen, last seen, number of rows)
+    """
+    ond_index = _COLUMNS.index("OnD")
+    search_time_index = _COLUMNS.index("search_time")
+    onds = {}
+    for row in rows:
+        ond = row[ond_index]
+        search_time = row[search_time_index]
+        if ond in onds:
+            first_seen, last_seen, row_count = onds[ond]
+            onds[ond] = (
+                min(first_seen, search_time),
+                max(last_seen, search_time),
+                row_count + 1,
             )
+        else:
+            onds[ond] = (search_time, search_time, 1)
+    return onds
 
-            for reco in json_data["recos"]:
-                passengers = json_data["passengers_string"]
-                cabin = reco["main_cabin"]
-                stay_duration = -1
-                try:
-                    if len(json_data["request_dep_date"]) > 1:
-                        stay_duration = (datetime.strptime(json_data["request_return_date"], "%Y-%m-%d") - datetime.strptime(json_data["request_dep_date"], "%Y-%m-%d")).days
-                except Exception as e:
-                    print(f"Error calculating stay duration: {e}")
-
-                sql = f"""
-                    INSERT INTO {PG_TABLE} (search_id, search_country, OnD, trip_type, main_airline,
-                                            price_EUR, advance_purchase, number_of_flights, search_time,
-                                            passengers, cabin, stay_duration)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """
-                cursor.execute(
-                    sql,
-                    (
-                        search_id,
-                        search_country,
-                        OnD,
-                        trip_type,
-                        reco["main_marketing_airline"],
-                        reco["price_EUR"],
-                        json_data["advance_purchase"],
-                        reco["nb_of_flights"],
-                        timestamp,
-                        passengers,
-                        cabin,
-                        stay_duration
-                    ),
-                )
 
-                conn.commit()
+def upsert_onds(cursor, onds):
+    """
+    Adds the OnDs of loaded rows to the catalogue
+    :param cursor: psycopg2 cursor
+    :param onds: dict returned by ond_summary
+    """
+    execute_values(
+        cursor,
+        f"""
+        INSERT INTO {PG_OND_TABLE} (OnD, origin, destination, first_seen, last_seen, row_count)
+        VALUES %s
+        ON CONFLICT (OnD)
+        DO UPDATE SET first_seen = LEAST({PG_OND_TABLE}.first_seen, EXCLUDED.first_seen),
+                      last_seen = GREATEST({PG_OND_TABLE}.last_seen, EXCLUDED.last_seen),
+                      row_count = {PG_OND_TABLE}.row_count + EXCLUDED.row_count
+        """,
+        [
+            (ond, *ond.split("-", 1), first_seen, last_seen, row_count)
+            for ond, (first_seen, last_seen, row_count) in sorted(onds.items())
+        ],
+    )
+
+
+def create_watermark_table(cursor):
+    create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {PG_WATERMARK_TABLE} (
+            name VARCHAR PRIMARY KEY,
+            version BIGINT,
+            loaded_at TIMESTAMP
+        )
+    """
+    cursor.execute(create_table_sql)
+
+
+def bump_watermark(cursor):
+    cursor.execute(
+        f"""
+        INSERT INTO {PG_WATERMARK_TABLE} (name, version, loaded_at)
+        VALUES (%s, 1, now())
+        ON CONFLICT (name)
+        DO UPDATE SET version = {PG_WATERMARK_TABLE}.version + 1, loaded_at = now()
+        """,
+        (PG_TABLE,),
+    )
+
+
+def price_bin(price):
+    """
+    :param price: price in EUR
+    :return: (bin number, geometric center of the bin)
+    """
+    if price <= 0:
+        return _ROLLUP_FREE_BIN, 0.0
+    # same expression as the backfill of create_rollup_table
+    bin_number = math.floor(math.log(price) / math.log(ROLLUP_BIN_RATIO))
+    return bin_number, ROLLUP_BIN_RATIO ** (bin_number + 0.5)
+
+
+def rollup_counts(rows):
+    """
+    Rolls rows up into search counts per bucket and min price bin, like the inner
+    query of /api/flights: min price per search and main airline (per cabin, and
+    over all cabins)
+    :param rows: list of tuples in _COLUMNS order
+    :return counts: Counter (OnD, main_airline, advance_purchase, trip_type, cabin, day, price_bin, bin_price) -> searches
+    """
+    min_prices = {}
+    for row in rows:
+        row = dict(zip(_COLUMNS, row))
+        for cabin in (row["cabin"], _ROLLUP_ALL_CABINS):
+            key = (
+                row["search_id"],
+                row["OnD"],
+                row["main_airline"],
+                row["advance_purchase"],
+                row["trip_type"],
+                cabin,
+                row["search_time"].date(),
+            )
+            if key not in min_prices or row["price_EUR"] < min_prices[key]:
+                min_prices[key] = row["price_EUR"]
+
+    counts = Counter()
+    for key, min_price in min_prices.items():
+        counts[key[1:] + price_bin(min_price)] += 1
+    return counts
+
+
+def upsert_rollup(cursor, counts):
+    """
+    Adds search counts to the rollup table
+    :param cursor: psycopg2 cursor
+    :param counts: Counter returned by rollup_counts
+    """
+    execute_values(
+        cursor,
+        f"""
+        INSERT INTO {PG_ROLLUP_TABLE} (OnD, main_airline, advance_purchase, trip_type,
+                                       cabin, day, price_bin, bin_price, searches)
+        VALUES %s
+        ON CONFLICT (OnD, main_airline, advance_purchase, trip_type, cabin, day, price_bin)
+        DO UPDATE SET searches = {PG_ROLLUP_TABLE}.searches + EXCLUDED.searches
+        """,
+        [key + (searches,) for key, searches in counts.items()],
+    )
+
+
+def decode_search(value):
+    # searches are produced either in json or in compact binary format
+    if compactCodec.is_compact(value):
+        return compactCodec.decode(value)
+    return jsonCodec.loads(value)
+
+
+def search_to_rows(json_data):
+    """
+    Maps a decorated search to the rows of the table, one per reco
+    :param json_data: decorated search dict
+    :return rows: list of tuples in _COLUMNS order
+    """
+    search_id = json_data["search_id"]
+    search_country = json_data["search_country"]
+    OnD = json_data["OnD"]
+    trip_type = json_data["trip_type"]
+    timestamp = isoDates.parse_timestamp(
+        json_data["search_date"], json_data["search_time"]
+    )
+    passengers = json_data["passengers_string"]
+
+    # same for all the recos of the search, computed by the reader's decoration
+    stay_duration = json_data.get("stay_duration")
+    if stay_duration is None:
+        stay_duration = -1
+        if json_data["request_return_date"]:
+            try:
+                stay_duration = isoDates.day_number(
+                    json_data["request_return_date"]
+                ) - isoDates.day_number(json_data["request_dep_date"])
+            except ValueError as e:
+                print(f"Error calculating stay duration: {e}")
+
+    return [
+        (
+            search_id,
+            search_country,
+            OnD,
+            trip_type,
+            reco["main_marketing_airline"],
+            reco["price_EUR"],
+            json_data["advance_purchase"],
+            reco["nb_of_flights"],
+            timestamp,
+            passengers,
+            reco["main_cabin"],
+            stay_duration,
+        )
+        for reco in json_data["recos"]
+    ]
+
+
+def copy_rows(cursor, rows):
+    """
+    Loads rows with a single COPY FROM STDIN
+    :param cursor: psycopg2 cursor
+    :param rows: list of tuples in _COLUMNS order
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {PG_TABLE} ({', '.join(_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+
+
+def flush_rows(conn, consumer, rows):
+    """
+    Writes the buffered rows, their rollup, their OnDs and the new watermark in one transaction,
+    then commits the Kafka offsets of the messages they come from: a failure before
+    the DB commit replays them.
+    :param conn: psycopg2 connection
+    :param consumer: Kafka consumer
+    :param rows: list of tuples in _COLUMNS order
+    """
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cursor:
+            copy_rows(cursor, rows)
+            upsert_rollup(cursor, rollup_counts(rows))
+            upsert_onds(cursor, ond_summary(rows))
+            bump_watermark(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        stats["flush_errors"] += 1
+        raise
+    consumer.commit(asynchronous=False)
+    stage_seconds.observe("flush", time.perf_counter() - start)
+    stats["flushes"] += 1
+    stats["rows_loaded"] += len(rows)
+
+
+def update_consumer_lag(consumer):
+    positions = {
+        (tp.topic, tp.partition): tp.offset
+        for tp in consumer.position(consumer.assignment())
+    }
+    for partition, lag in metrics.kafka_lag(consumer, positions).items():
+        consumer_lag.set(partition, lag)
+
+
+def populate_postgres_from_kafka():
+    print("Consumer started")
+    consumer = create_consumer()
+    conn = psycopg2.connect(
+        host=PG_HOST,
+        port=PG_PORT,
+        dbname=PG_DATABASE,
+        user=PG_USER,
+        password=PG_PASSWORD,
+    )
+    try:
+        with conn.cursor() as cursor:
+            partitioned = create_table(cursor)
+            create_rollup_table(cursor)
+            create_ond_table(cursor)
+            create_watermark_table(cursor)
+        conn.commit()
+        if partitioned:
+            create_partitions(conn, partition_months([]))
+
+        rows = []
+        messages = 0
+        last_flush = time.time()
+        while True:
+            start = time.perf_counter()
+            msg = consumer.poll(timeout=1.0)
+            if msg is not None:
+                if msg.error():
+                    if msg.error().code() == KafkaError._PARTITION_EOF:
+                        print(
+                            f"Consumer reached end of partition {msg.topic()} [{msg.partition()}]"
+                        )
+                    elif msg.error():
+                        print(f"Error: {msg.error()}")
+                        stats["kafka_errors"] += 1
+                else:
+                    decode_start = time.perf_counter()
+                    stage_seconds.observe("consume", decode_start - start)
+                    search = decode_search(msg.value())
+                    rows_start = time.perf_counter()
+                    stage_seconds.observe("decode", rows_start - decode_start)
+                    rows.extend(search_to_rows(search))
+                    stage_seconds.observe("rows", time.perf_counter() - rows_start)
+                    messages += 1
+                    stats["messages"] += 1
+                    buffered_rows.set("rows", len(rows))
+
+            # flushing on size, or on time so that rows do not wait on a quiet topic
+            if messages > 0 and (
+                len(rows) >= WRITER_BATCH_ROWS
+                or time.time() - last_flush >= WRITER_FLUSH_INTERVAL
+            ):
+                if partitioned:
+                    create_partitions(conn, partition_months(rows))
+                flush_rows(conn, consumer, rows)
+                print(f"Loaded {len(rows)} rows from {messages} searches")
+                update_consumer_lag(consumer)
+                rows = []
+                buffered_rows.set("rows", 0)
+                messages = 0
+                last_flush = time.time()
 
     except KeyboardInterrupt:
-        consumer.close()
-        cursor.close()
-        conn.close()
+        # rows not flushed yet are not committed in Kafka either: they will be replayed
+        pass
 
     finally:
         consumer.close()
-        cursor.close()
         conn.close()
 
 
 if __name__ == "__main__":
+    metrics.start_http_server(METRICS_PORT)
     populate_postgres_from_kafka()
@@ -0,0 +1,81 @@
+"""
+Memoized geography lookups in front of neobase.
+
+The set of airport and city codes met in the traffic is small (a few thousand codes)
+and the airport pairs are highly skewed, so the neobase lookups done for each flight
+are cached:
+* per code records (country, primary city), kept for the whole life of the process
+* pair distances, in a bounded LRU cache
+
+"""
+
+import os
+import functools
+
+# max number of airport pairs kept in the distance cache
+DISTANCE_CACHE_SIZE = int(os.getenv("GEO_DISTANCE_CACHE_SIZE", 100000))
+
+
+class GeoCache:
+    """
+    Cached geography lookups: country, primary city and rounded distances
+    """
+
+    def __init__(self, neob, distance_cache_size=DISTANCE_CACHE_SIZE):
+        """
+        :param neob: neobase object used on cache misses
+        :param distance_cache_size: max number of pairs in the distance LRU cache
+        """
+        self.neob = neob
+        self._record = functools.lru_cache(maxsize=None)(self._load_record)
+        self._distance = functools.lru_cache(maxsize=distance_cache_size)(
+            self._load_distance
+        )
+
+    def _load_record(self, code):
+        return (
+            self.neob.get(code, "country_code"),
+            self.neob.get(code, "city_code_list")[0],
+        )
+
+    def _load_distance(self, code1, code2):
+        return round(self.neob.distance(code1, code2))
+
+    def country(self, code):
+        """
+        :param code: airport or city code
+        :return: 2-letter country code
+        """
+        return self._record(code)[0]
+
+    def city(self, code):
+        """
+        :param code: airport or city code (a city is its own primary city)
+        :return: 3-letter code of the first city served by the airport
+        """
+        return self._record(code)[1]
+
+    def distance(self, code1, code2):
+        """
+        :param code1, code2: airport or city codes
+        :return: distance in km, rounded to the closest integer
+        """
+        # the distance is symmetric: A-B and B-A share the same cache entry
+        if code1 > code2:
+            code1, code2 = code2, code1
+        return self._distance(code1, code2)
+
+    def stats(self):
+        """
+        :return: dict with hit/miss counters and sizes of both caches
+        """
+        record_info = self._record.cache_info()
+        distance_info = self._distance.cache_info()
+        return {
+            "record_hits": record_info.hits,
+            "record_misses": record_info.misses,
+            "record_size": record_info.currsize,
+            "distance_hits": distance_info.hits,
+            "distance_misses": distance_info.misses,
+            "distance_size": distance_info.currsize,
+        }
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+Tool to precompute the geography data used by the decoration into a binary file,
+and reader of that file through mmap.
+
+The file holds, for a set of airport/city codes, the country, the primary city and
+the rounded distance between all pairs of codes. The decorator maps it in memory
+at startup (GEO_MATRIX_FILE environment variable): lookups are array indexing, the
+NeoBase object is only built for codes missing from the file, and all the
+decorators of a host share the same pages.
+
+> python3 geoMatrix.py -h
+
+File layout (little endian):
+* header: magic "GEOM", version (uint16), number of codes n (uint32)
+* n codes (3 bytes each), n countries (2 bytes each), n cities (3 bytes each)
+* n x n distance matrix in km (uint16), 65535 for distances neobase cannot compute
+
+"""
+
+import logging
+import argparse
+import array
+import mmap
+import os
+import struct
+import sys
+
+_MAGIC = b"GEOM"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+_CODE_SIZE = 3
+_COUNTRY_SIZE = 2
+_CITY_SIZE = 3
+# max distance on earth is about 20000 km, the max value marks unknown distances
+_UNKNOWN_DISTANCE = 0xFFFF
+_MAX_DISTANCE = _UNKNOWN_DISTANCE - 1
+
+logger = logging.getLogger()
+
+
+class GeoMatrix:
+    """
+    Geography lookups from a precomputed, memory mapped, file.
+    Same interface as geoCache.GeoCache.
+    """
+
+    def __init__(self, matrix_file, fallback=None):
+        """
+        :param matrix_file: file written by write_matrix
+        :param fallback: function returning the object to use for codes missing from the file
+        """
+        if sys.byteorder != "little":
+            raise ValueError("Geo matrix files can only be read on little endian hosts")
+        with open(matrix_file, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{matrix_file} is not a version {_VERSION} geo matrix file")
+
+        offset = _HEADER.size
+        codes = self._read_strings(offset, n, _CODE_SIZE)
+        offset += n * _CODE_SIZE
+        countries = self._read_strings(offset, n, _COUNTRY_SIZE)
+        offset += n * _COUNTRY_SIZE
+        cities = self._read_strings(offset, n, _CITY_SIZE)
+        offset += n * _CITY_SIZE
+
+        self.size = n
+        self._index = {code: i for i, code in enumerate(codes)}
+        self._records = dict(zip(codes, zip(countries, cities)))
+        self._distances = memoryview(self._mm)[offset : offset + 2 * n * n].cast("H")
+        self._fallback_factory = fallback
+        self._fallback = None
+        self._misses = 0
+
+    def _read_strings(self, offset, n, size):
+        data = self._mm[offset : offset + n * size].decode("ascii")
+        return [data[i : i + size].rstrip() for i in range(0, n * size, size)]
+
+    def fallback(self):
+        """
+        :return: the object used for codes missing from the file
+        """
+        self._misses += 1
+        if self._fallback is None:
+            if self._fallback_factory is None:
+                raise KeyError("Code not found in geo matrix and no fallback")
+            self._fallback = self._fallback_factory()
+        return self._fallback
+
+    def country(self, code):
+        record = self._records.get(code)
+        if record is None or record[0] == "":
+            return self.fallback().country(code)
+        return record[0]
+
+    def city(self, code):
+        record = self._records.get(code)
+        if record is None or record[1] == "":
+            return self.fallback().city(code)
+        return record[1]
+
+    def distance(self, code1, code2):
+        i = self._index.get(code1)
+        j = self._index.get(code2)
+        if i is None or j is None:
+            return self.fallback().distance(code1, code2)
+        distance = self._distances[i * self.size + j]
+        if distance == _UNKNOWN_DISTANCE:
+            return self.fallback().distance(code1, code2)
+        return distance
+
+    def stats(self):
+        stats = {"matrix_size": self.size, "matrix_misses": self._misses}
+        if self._fallback is not None:
+            stats.update(self._fallback.stats())
+        return stats
+
+    def close(self):
+        self._distances.release()
+        self._mm.close()
+
+
+def write_matrix(matrix_file, codes, neob):
+    """
+    Precomputes countries, cities and distances of the given codes
+    :param matrix_file: name of the file to write
+    :param codes: iterable of 3-letter airport or city codes
+    :param neob: neobase object
+    :return: n: number of codes written
+    """
+    if sys.byteorder != "little":
+        raise ValueError("Geo matrix files can only be written on little endian hosts")
+    codes = sorted(
+        code
+        for code in set(codes)
+        if len(code) == _CODE_SIZE and code.isascii() and code in neob
+    )
+    n = len(codes)
+    logger.info(f"Computing {n * (n - 1) // 2} distances between {n} codes")
+    locations = [neob.get_location(code) for code in codes]
+
+    with open(matrix_file, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, n))
+        for code in codes:
+            f.write(code.encode("ascii"))
+        for code in codes:
+            country = neob.get(code, "country_code") or ""
+            f.write(country.encode("ascii").ljust(_COUNTRY_SIZE)[:_COUNTRY_SIZE])
+        for code in codes:
+            cities = neob.get(code, "city_code_list")
+            city = cities[0] if cities else ""
+            f.write(city.encode("ascii").ljust(_CITY_SIZE)[:_CITY_SIZE])
+
+        # distances are symmetric: computing the upper triangle only
+        rows = [array.array("H", bytes(2 * n)) for _ in range(n)]
+        for i in range(n):
+            row = rows[i]
+            for j in range(i + 1, n):
+                d = neob.distance_between_locations(locations[i], locations[j])
+                d = min(round(d), _MAX_DISTANCE) if d is not None else _UNKNOWN_DISTANCE
+                row[j] = d
+                rows[j][i] = d
+            f.write(row.tobytes())
+            rows[i] = None  # row i is no longer needed
+    return n
+
+
+def traffic_codes(input_files):
+    """
+    Collects the airport and city codes seen in travel data files
+    :param input_files: gziped or plain CSV files
+    :return codes: set of codes
+    """
+    from recoReader import process_input_file, decode_line
+
+    codes = set()
+    for input_file in input_files:
+        for line in process_input_file(input_file):
+            reco = decode_line(line)
+            if reco is None:
+                continue
+            codes.add(reco["origin_city"])
+            codes.add(reco["destination_city"])
+            for flight in reco["flights"]:
+                codes.add(flight["dep_airport"])
+                codes.add(flight["arr_airport"])
+    return codes
+
+
+if __name__ == "__main__":
+    import neobase
+
+    logging.basicConfig(
+        format="%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(description="Geo matrix builder")
+    parser.add_argument("output_file", help="Geo matrix file to write")
+    parser.add_argument(
+        "input_files",
+        help="Travel data files (gziped or plain csv) to take the codes from",
+        nargs="*",
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        help="Take all the codes known by neobase instead (large file: about 650MB)",
+        action="store_true",
+    )
+    arguments = parser.parse_args()
+    if not arguments.all and not arguments.input_files:
+        parser.error("input files are required unless --all is used")
+
+    neob = neobase.NeoBase()
+    if arguments.all:
+        codes = neob.keys()
+    else:
+        codes = traffic_codes(arguments.input_files)
+    n = write_matrix(arguments.output_file, codes, neob)
+    logger.info(
+        f"{n} codes written to {arguments.output_file} "
+        f"({os.path.getsize(arguments.output_file)} bytes)"
+    )
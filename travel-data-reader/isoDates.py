@@ -0,0 +1,48 @@
+"""
+ISO date parsing shared by the reader and the writer.
+
+Dates of the traffic (search, departure and return dates) take a few hundred
+values, so their parsing is memoized; times are parsed with fromisoformat, much
+faster than strptime. Invalid values raise ValueError, like strptime.
+
+"""
+
+import datetime
+import functools
+import os
+
+# max number of date strings kept parsed
+DATE_CACHE_SIZE = int(os.getenv("DATE_CACHE_SIZE", 4096))
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    """
+    :param value: date as YYYY-MM-DD
+    :return: datetime.date
+    """
+    if len(value) != 10:
+        # fromisoformat also takes other forms, like YYYYMMDD since python 3.11
+        raise ValueError(f"Invalid date: {value!r}")
+    return datetime.date.fromisoformat(value)
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def day_number(value):
+    """
+    :param value: date as YYYY-MM-DD
+    :return: proleptic Gregorian ordinal of the date, differences are numbers of days
+    """
+    return parse_date(value).toordinal()
+
+
+def parse_timestamp(date_value, time_value):
+    """
+    :param date_value: date as YYYY-MM-DD
+    :param time_value: time as HH:MM:SS
+    :return: datetime.datetime
+    """
+    if len(date_value) != 10 or len(time_value) != 8:
+        raise ValueError(f"Invalid timestamp: {date_value!r} {time_value!r}")
+    return datetime.datetime.fromisoformat(f"{date_value}T{time_value}")
+
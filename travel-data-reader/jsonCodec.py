@@ -0,0 +1,85 @@
+"""
+JSON codec shared by the reader and the writer.
+
+Uses orjson or msgspec when installed, the standard json module otherwise. The codec
+can be forced with the JSON_CODEC environment variable (orjson, msgspec or json).
+All codecs encode directly to UTF-8 bytes and decode bytes or str, raising
+ValueError on invalid documents.
+
+"""
+
+import os
+import json
+
+
+def _stdlib_codec():
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def dumps_pretty(obj):
+        return json.dumps(obj, indent=2).encode("utf-8")
+
+    return loads, dumps, dumps_pretty
+
+
+def _orjson_codec():
+    import orjson
+
+    def dumps_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    # orjson.JSONDecodeError is a ValueError
+    return orjson.loads, orjson.dumps, dumps_pretty
+
+
+def _msgspec_codec():
+    import msgspec
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def dumps_pretty(obj):
+        return msgspec.json.format(encoder.encode(obj), indent=2)
+
+    return loads, encoder.encode, dumps_pretty
+
+
+_CODECS = {
+    "orjson": _orjson_codec,
+    "msgspec": _msgspec_codec,
+    "json": _stdlib_codec,
+}
+
+
+def select_codec(name=None):
+    """
+    Selects the codec used by loads, dumps and dumps_pretty
+    :param name: codec name, or None for the first codec available in _CODECS order
+    :return: name of the selected codec
+    """
+    global codec_name, loads, dumps, dumps_pretty
+    if name:
+        loads, dumps, dumps_pretty = _CODECS[name]()
+        codec_name = name
+        return codec_name
+    for candidate, codec in _CODECS.items():
+        try:
+            loads, dumps, dumps_pretty = codec()
+        except ImportError:
+            continue
+        codec_name = candidate
+        return codec_name
+
+
+codec_name = None
+loads = dumps = dumps_pretty = None
+select_codec(os.getenv("JSON_CODEC"))
@@ -0,0 +1,221 @@
+"""
+Minimal Prometheus instrumentation shared by the reader and the writer daemons.
+
+Metrics live in the process and are served in the Prometheus text format on
+http://<host>:<port>/metrics by a daemon thread (start_http_server). Each metric has
+a single label: the stage for latencies, the queue for depths, the event for counters.
+Counters already kept in a dict (such as the Counter of recoReader.process) are
+exposed as they are with Collected, without a second count.
+
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+# latency buckets in seconds, from a line decoding to a database flush
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+)
+
+REGISTRY = []
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Latency histogram, one series per label value
+    """
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                # bucket counts, then sum and count
+                series = self.series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, label_value):
+        return _Timer(self, label_value)
+
+    def samples(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                label = f'{self.label}="{label_value}"'
+                cumulated = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulated += count
+                    lines.append(
+                        f'{self.name}_bucket{{{label},le="{_format_value(bound)}"}} {cumulated}'
+                    )
+                lines.append(f"{self.name}_sum{{{label}}} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(self.label_value, time.perf_counter() - self.start)
+
+
+class Gauge:
+    """
+    Values set by the code, one per label value
+    """
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        REGISTRY.append(self)
+
+    def set(self, label_value, value):
+        self.values[label_value] = value
+
+    def samples(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_value, value in sorted(self.values.copy().items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {_format_value(value)}')
+        return lines
+
+
+class Collected:
+    """
+    Counters or gauges read from dicts (label value -> value) when the metrics are served
+    """
+
+    def __init__(self, name, help, label, type="counter"):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.type = type
+        self.sources = {}
+        REGISTRY.append(self)
+
+    def track(self, name, source, keys=None):
+        """
+        :param name: name of the source, tracking a new source with the same name replaces it
+        :param source: dict, or function returning a dict
+        :param keys: keys of the dict to expose, default is all the numeric ones
+        """
+        self.sources[name] = (source, keys)
+
+    def samples(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        values = {}
+        for source, keys in list(self.sources.values()):
+            data = source() if callable(source) else source
+            for key, value in list(data.items()):
+                if (keys is None or key in keys) and isinstance(value, (int, float)):
+                    values[key] = value
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{{{self.label}="{key}"}} {_format_value(value)}')
+        return lines
+
+
+class Stopwatch:
+    """
+    Time of a stage measured piece by piece, e.g. line by line
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+
+
+def render():
+    """
+    :return: all the metrics, in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no log line per scrape
+
+
+def start_http_server(port):
+    """
+    Serves the metrics in a daemon thread
+    :param port: port to listen to, 0 disables the endpoint
+    :return server: the HTTP server, None when disabled
+    """
+    if not port:
+        return None
+    server = http.server.ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Metrics served on port {server.server_port}")
+    return server
+
+
+def kafka_lag(consumer, positions):
+    """
+    Consumer lag per partition, from the high watermarks the consumer already knows
+    :param consumer: confluent_kafka Consumer
+    :param positions: dict (topic, partition) -> next offset to consume
+    :return lags: dict "topic/partition" -> number of messages behind
+    """
+    from confluent_kafka import TopicPartition
+
+    lags = {}
+    for (topic, partition), position in positions.items():
+        low, high = consumer.get_watermark_offsets(
+            TopicPartition(topic, partition), cached=True
+        )
+        if high >= 0 and position >= 0:
+            lags[f"{topic}/{partition}"] = max(high - position, 0)
+    return lags
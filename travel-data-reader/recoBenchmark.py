@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmarks of the reader and writer stages, on synthetic travel data
+(travelDataGenerator.py).
+
+> python3 recoBenchmark.py -h
+
+Each stage runs in its own process: the input data is generated and prepared first,
+then the stage is timed. Reported for each stage: records per second (input lines
+for the decoding and end to end stages, searches for the others), the peak RSS of the
+process and its growth while the stage ran. The end to end stage reads a generated
+file, decorates, encodes in json and maps the searches to writer rows (no Kafka, no
+PostgreSQL).
+
+"""
+
+import argparse
+import concurrent.futures
+import gzip
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import decoratedRecoWriter
+import recoReader
+from travelDataGenerator import TravelDataGenerator, CURRENCIES
+
+logger = logging.getLogger()
+
+DEFAULT_RATES_FILE = os.path.join(os.path.dirname(__file__), "etc/eurofxref.csv")
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+
+def generate_lines(options):
+    generator = TravelDataGenerator(
+        options.seed,
+        options.recos,
+        options.legs,
+        options.currencies.split(","),
+        options.ond_skew,
+    )
+    return list(generator.lines(options.searches))
+
+
+def decorated_searches(lines, rates):
+    decorate = recoReader.group_and_decorate
+    return [
+        decorate(recos, rates) for recos in recoReader.group_recos(lines, Counter())
+    ]
+
+
+def stage_decode_line(options, lines, rates):
+    decode_line = recoReader.decode_line
+    return lambda: sum(1 for line in lines if decode_line(line)), len(lines)
+
+
+def stage_decode_lines(options, lines, rates):
+    return lambda: sum(1 for _ in recoReader.decode_lines(lines, Counter())), len(lines)
+
+
+def stage_decorate(options, lines, rates):
+    groups = list(recoReader.group_recos(lines, Counter()))
+    decorate = recoReader.group_and_decorate
+    # warm up: geography init and caches
+    decorate(groups[0], rates)
+    return lambda: [decorate(recos, rates) for recos in groups], len(groups)
+
+
+def encode_stage(name):
+    def stage(options, lines, rates):
+        searches = decorated_searches(lines, rates)
+        encoder = recoReader.encoders[name]
+        return lambda: [encoder(search) for search in searches], len(searches)
+
+    return stage
+
+
+def stage_writer_decode(options, lines, rates):
+    values = [recoReader.encoder_json(s) for s in decorated_searches(lines, rates)]
+    decode_search = decoratedRecoWriter.decode_search
+    return lambda: [decode_search(value) for value in values], len(values)
+
+
+def stage_writer_rows(options, lines, rates):
+    searches = decorated_searches(lines, rates)
+    search_to_rows = decoratedRecoWriter.search_to_rows
+    return lambda: [search_to_rows(search) for search in searches], len(searches)
+
+
+def stage_end_to_end(options, lines, rates):
+    input_file = os.path.join(options.tmp_dir, "benchmark.csv.gz")
+    with gzip.open(input_file, "wb") as f:
+        f.writelines(lines)
+
+    class args:
+        pass
+
+    args.input_file = input_file
+    args.rates_file = options.rates_file
+    args.workers = options.workers
+
+    def run():
+        for search in recoReader.process(args):
+            value = recoReader.encoder_json(search)
+            decoratedRecoWriter.search_to_rows(decoratedRecoWriter.decode_search(value))
+
+    return run, len(lines)
+
+
+def stages():
+    """
+    :return: dict stage name -> function preparing the stage, returning the function
+             to time and the number of records it processes
+    """
+    result = {
+        "decode_line": stage_decode_line,
+        "decode_lines": stage_decode_lines,
+        "decorate": stage_decorate,
+    }
+    for name in recoReader.encoders:
+        result[f"encode_{name}"] = encode_stage(name)
+    result["writer_decode"] = stage_writer_decode
+    result["writer_rows"] = stage_writer_rows
+    result["end_to_end"] = stage_end_to_end
+    return result
+
+
+def run_stage(name, options):
+    """
+    Runs a stage, in a process of its own
+    :param name: stage name
+    :param options: benchmark options
+    :return: dict with the stage measures
+    """
+    logger.setLevel(logging.WARNING)
+    rates = recoReader.load_rates(options.rates_file)
+    lines = generate_lines(options)
+    run, records = stages()[name](options, lines, rates)
+    rss_before = peak_rss_mb()
+    seconds = None
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return {
+        "stage": name,
+        "records": records,
+        "seconds": round(seconds, 4),
+        "records_per_sec": round(records / seconds),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "peak_rss_growth_mb": round(peak_rss_mb() - rss_before, 1),
+    }
+
+
+def benchmark(names, options):
+    """
+    :param names: stages to run
+    :param options: benchmark options
+    :return: iterator on the measures of each stage
+    """
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            yield executor.submit(run_stage, name, options).result()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        format="%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(description="Reader and writer benchmarks")
+    parser.add_argument(
+        "stages",
+        help=f"Stages to run. Default is all: {', '.join(stages())}",
+        nargs="*",
+    )
+    parser.add_argument(
+        "-n", "--searches", help="Number of searches", type=int, default=2000
+    )
+    parser.add_argument(
+        "--recos", help="Average number of recos per search", type=int, default=20
+    )
+    parser.add_argument(
+        "--legs", help="Max number of flights per direction", type=int, default=2
+    )
+    parser.add_argument(
+        "--currencies",
+        help="Comma separated currencies of the searches",
+        default=",".join(CURRENCIES),
+    )
+    parser.add_argument(
+        "--ond_skew",
+        help="Zipf exponent of the OnD distribution, 0 for uniform",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument("-s", "--seed", help="Random seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", help="Runs of each stage, the best is kept", type=int, default=3
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Decoration processes of the end to end stage",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-r", "--rates_file", help="Currency rates file", default=DEFAULT_RATES_FILE
+    )
+    parser.add_argument("--json", help="File to write the results to, as json lines")
+    options = parser.parse_args()
+
+    unknown = set(options.stages) - set(stages())
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as options.tmp_dir:
+        print(f"{'stage':<20} {'records':>9} {'seconds':>9} {'records/s':>11} {'peak RSS MB':>12} {'growth MB':>10}")
+        results = []
+        for result in benchmark(options.stages or list(stages()), options):
+            results.append(result)
+            print(
+                f"{result['stage']:<20} {result['records']:>9} {result['seconds']:>9} "
+                f"{result['records_per_sec']:>11} {result['peak_rss_mb']:>12} "
+                f"{result['peak_rss_growth_mb']:>10}"
+            )
+
+    if options.json:
+        with open(options.json, "w") as f:
+            for result in results:
+                f.write(recoReader.jsonCodec.dumps(result).decode("utf-8") + "\n")
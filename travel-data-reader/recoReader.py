@@ -10,25 +10,56 @@ Tool to decode, group and decorate and display Travel recommendations.
 import logging
 import argparse
 import sys
+import io
 import gzip
-import json
-import datetime
 import neobase
 import os
+import geoCache
+import geoMatrix
+import jsonCodec
+import metrics
+import compactCodec
+import currencyRates
+import isoDates
 import time
-from collections import Counter
-from confluent_kafka import (
-    Consumer,
-    KafkaError,
-    TopicPartition,
-    OFFSET_BEGINNING,
-    Producer,
-)
+import concurrent.futures
+import contextlib
+import itertools
+import linecache
+import signal
+import threading
+from collections import Counter, OrderedDict, deque
 
 KAFKA_BROKER = os.getenv("KAFKA_BROKER", "localhost:9092")
 KAFKA_GROUP_ID = os.getenv("KAFKA_GROUP_ID", "default-group")
 KAFKA_INPUT_TOPIC = os.getenv("KAFKA_INPUT_TOPIC", "flight-searches")
 KAFKA_OUTPUT_TOPIC = os.getenv("KAFKA_OUTPUT_TOPIC", "decorated-recos")
+# Producer batching
+KAFKA_LINGER_MS = int(os.getenv("KAFKA_LINGER_MS", 50))
+KAFKA_BATCH_SIZE = int(os.getenv("KAFKA_BATCH_SIZE", 1 << 20))
+KAFKA_COMPRESSION = os.getenv("KAFKA_COMPRESSION", "lz4")
+KAFKA_FLUSH_TIMEOUT = float(os.getenv("KAFKA_FLUSH_TIMEOUT", 30))
+# Consumer batching: 0 means one poll() per message with auto commit
+KAFKA_CONSUME_BATCH_SIZE = int(os.getenv("KAFKA_CONSUME_BATCH_SIZE", 500))
+
+# Port of the metrics endpoint (Prometheus format), 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9101))
+
+# Grouping window: the recos of a search can be interleaved with the ones of other
+# searches. A search is flushed once idle for GROUP_IDLE_TIMEOUT seconds, or earlier
+# (least recently updated first) when more than GROUP_MAX_SEARCHES searches are open
+# or more than GROUP_MAX_RECOS recos are buffered. GROUP_MAX_SEARCHES=1 only groups
+# consecutive recos.
+GROUP_IDLE_TIMEOUT = float(os.getenv("GROUP_IDLE_TIMEOUT", 2))
+GROUP_MAX_SEARCHES = int(os.getenv("GROUP_MAX_SEARCHES", 100))
+GROUP_MAX_RECOS = int(os.getenv("GROUP_MAX_RECOS", 100000))
+
+# Precomputed geography file written by geoMatrix.py (optional)
+GEO_MATRIX_FILE = os.getenv("GEO_MATRIX_FILE")
+
+# File input: size of the read buffer and of the chunks of lines handed to the decoder
+READ_BUFFER_SIZE = int(os.getenv("READ_BUFFER_SIZE", 1 << 20))
+_GZIP_MAGIC = b"\x1f\x8b"
 
 _RECO_LAYOUT = [
     "version_nb",
@@ -70,9 +101,77 @@ logging.basicConfig(
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Metrics
+stage_seconds = metrics.Histogram(
+    "reader_stage_seconds",
+    "Time spent per stage: consume (per batch), decode, decorate and encode (per search), "
+    "produce (delivery latency)",
+    "stage",
+)
+queue_depth = metrics.Gauge(
+    "reader_queue_depth",
+    "Messages in the producer queue, searches in the decoration pool, "
+    "searches and recos being grouped",
+    "queue",
+)
+consumer_lag = metrics.Gauge(
+    "reader_consumer_lag", "Messages not consumed yet, per partition", "partition"
+)
+events = metrics.Collected(
+    "reader_events_total",
+    "Lines read, decoded and malformed, searches decorated, messages produced and failed",
+    "event",
+)
+geo_cache = metrics.Collected(
+    "reader_geo_cache", "Geography lookups: cache hits, misses and sizes", "stat", "gauge"
+)
+
+
+# File input
+def open_input_file(input_file, stack):
+    """
+    Opens a gziped or plain CSV file (or standard input) for buffered binary reading
+    :param input_file: path of the file to read, "-" for standard input
+    :param stack: contextlib.ExitStack closing the file (standard input is left open)
+    :return: stream: binary stream of decompressed CSV lines
+    """
+    if input_file == "-":
+        raw = sys.stdin.buffer
+    else:
+        raw = stack.enter_context(open(input_file, "rb", buffering=0))
+    stream = io.BufferedReader(raw, READ_BUFFER_SIZE)
+    # gzip is detected from the magic number so that it also works on standard input
+    if stream.peek(len(_GZIP_MAGIC))[: len(_GZIP_MAGIC)] == _GZIP_MAGIC:
+        # closing a GzipFile does not close the stream it reads: the stack does
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=stream), READ_BUFFER_SIZE)
+        if input_file != "-":
+            stack.enter_context(stream)
+    return stream
+
+
+def process_input_file(input_file):
+    """
+    Reads CSV lines from a file, by chunks of about READ_BUFFER_SIZE bytes
+    :param input_file: path of the file to read, "-" for standard input
+    :return lines: iterator on raw CSV lines (bytes)
+    """
+    with contextlib.ExitStack() as stack:
+        stream = open_input_file(input_file, stack)
+        while True:
+            lines = stream.readlines(READ_BUFFER_SIZE)
+            if not lines:
+                break
+            yield from lines
+
 
 # Kafka consumer
+# set on SIGTERM: the consumers stop and the searches being grouped are flushed
+shutdown = threading.Event()
+
+
 def process_kafka_messages():
+    from confluent_kafka import Consumer, KafkaError
+
     consumer = Consumer(
         {
             "bootstrap.servers": KAFKA_BROKER,
@@ -85,9 +184,11 @@ def process_kafka_messages():
     # )
     consumer.subscribe([KAFKA_INPUT_TOPIC])
     try:
-        while True:
+        while not shutdown.is_set():
             msg = consumer.poll(timeout=1.0)
             if msg is None:
+                # no line: lets the grouping flush the idle searches
+                yield None
                 continue
             if msg.error():
                 if msg.error().code() == KafkaError._PARTITION_EOF:
@@ -95,7 +196,7 @@ def process_kafka_messages():
                 else:
                     print("Consumer error: {}".format(msg.error()))
                     break
-            reco = json.loads(msg.value())["payload"]["column01"]
+            reco = jsonCodec.loads(msg.value())["payload"]["column01"]
             yield reco
     except KeyboardInterrupt:
         consumer.close()
@@ -103,29 +204,308 @@ def process_kafka_messages():
         consumer.close()
 
 
-# Kafka producer
-def produce_to_kafka(data_generator):
+def decode_envelopes(values):
     """
-    Function to produce JSON data to a Kafka topic.
+    Extracts the CSV lines from Kafka json envelopes, with a single json parsing
+    :param values: list of message values
+    :return lines: list of CSV lines
+    """
+    try:
+        envelopes = jsonCodec.loads(b"[" + b",".join(values) + b"]")
+    except ValueError:
+        # one bad envelope: decoding them one by one to keep the others
+        envelopes = []
+        for value in values:
+            try:
+                envelopes.append(jsonCodec.loads(value))
+            except ValueError:
+                logger.error("Failed at decoding Kafka message: %s" % value)
+    lines = []
+    for envelope in envelopes:
+        try:
+            lines.append(envelope["payload"]["column01"])
+        except (KeyError, TypeError):
+            logger.error("Unexpected Kafka message: %s" % envelope)
+    return lines
 
-    Parameters:
-        - topic: Name of the Kafka topic.
-        - data: JSON data to be sent to Kafka.
-        - bootstrap_servers: List of Kafka brokers (default: 'localhost:9092').
+
+class KafkaInput:
+    """
+    Messages consumed by batches, whose envelopes are decoded in bulk.
+    Offsets are committed manually: once the batch that follows a batch has been
+    requested and none of its lines is in a search still being grouped, decorated or
+    produced (all the lines of the older batch are in searches whose delivery was
+    acknowledged). A failed delivery stops the consumption: the offsets of its lines
+    are never committed. close() commits the batches delivered at the end.
+    """
+
+    def __init__(self, batch_size=KAFKA_CONSUME_BATCH_SIZE):
+        """
+        :param batch_size: max number of messages per batch
+        """
+        from confluent_kafka import Consumer
+
+        self.batch_size = batch_size
+        # SearchWindow of the grouping, set by process
+        self.window = None
+        # number of the first line of the searches out of the grouping, not delivered yet
+        self.in_flight = set()
+        # number of the first line of the searches produced, by message number
+        self.produced = {}
+        self.messages = 0
+        self.failed = 0
+        # (offsets, number of the last line) of each batch not committed yet
+        self.uncommitted = deque()
+        self.lines_read = 0
+        self.consumer = Consumer(
+            {
+                "bootstrap.servers": KAFKA_BROKER,
+                "group.id": KAFKA_GROUP_ID,
+                "enable.auto.commit": False,
+                "default.topic.config": {"auto.offset.reset": "earliest"},
+            }
+        )
+        self.consumer.subscribe([KAFKA_INPUT_TOPIC])
+
+    def batches(self):
+        """
+        :return batches: iterator on lists of CSV lines, empty when no message came
+        """
+        from confluent_kafka import KafkaError
+
+        try:
+            while not shutdown.is_set():
+                start = time.perf_counter()
+                msgs = self.consumer.consume(num_messages=self.batch_size, timeout=1.0)
+                if not msgs:
+                    # lets the grouping flush the idle searches
+                    yield []
+                    # and commits the searches delivered since the last batch
+                    self.commit()
+                    continue
+                stage_seconds.observe("consume", time.perf_counter() - start)
+                values = []
+                offsets = {}
+                for msg in msgs:
+                    if msg.error():
+                        if msg.error().code() == KafkaError._PARTITION_EOF:
+                            continue
+                        else:
+                            raise RuntimeError("Consumer error: {}".format(msg.error()))
+                    values.append(msg.value())
+                    offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+                if not values:
+                    continue
+                for partition, lag in metrics.kafka_lag(self.consumer, offsets).items():
+                    consumer_lag.set(partition, lag)
+                lines = decode_envelopes(values)
+                self.lines_read += len(lines)
+                self.uncommitted.append((offsets, self.lines_read))
+                yield lines
+
+                self.commit()
+        except RuntimeError as e:
+            logger.error(e)
+        except KeyboardInterrupt:
+            pass
+
+    def lines(self):
+        """
+        :return lines: iterator on CSV lines, None when no message came (see decode_lines)
+        """
+        return itertools.chain.from_iterable(
+            batch or (None,) for batch in self.batches()
+        )
+
+    def track(self, groups):
+        """
+        Keeps the searches out of the grouping in flight, until their delivery
+        :param groups: iterator on (number of the first line, recos of the same search)
+        :return groups: the same iterator
+        """
+        for first_line, recos in groups:
+            self.in_flight.add(first_line)
+            yield first_line, recos
+
+    def hand_over(self, first_line, search):
+        """
+        Numbers the searches handed to the producer, in production order
+        :param first_line: number of the first line of the search
+        :param search: decorated search, None when the decoration failed
+        """
+        if not search:
+            # nothing to deliver
+            self.in_flight.discard(first_line)
+            return
+        self.produced[self.messages] = first_line
+        self.messages += 1
+
+    def acknowledge(self, number, err):
+        """
+        Delivery callback of the producer, see produce_to_kafka
+        :param number: number of the message, in production order
+        :param err: delivery error, None when delivered
+        """
+        first_line = self.produced.pop(number)
+        if err is None:
+            self.in_flight.discard(first_line)
+        else:
+            # the search stays in flight: the offsets of its lines are not committed
+            self.failed += 1
+
+    def first_line_in_flight(self):
+        """
+        :return: number (from 1, over all the batches) of the first line in a search
+                 not delivered yet, None if none
+        """
+        first_line = min(self.in_flight, default=None)
+        buffered = self.window.first_line() if self.window is not None else None
+        if first_line is None or (buffered is not None and buffered < first_line):
+            return buffered
+        return first_line
+
+    def commit(self):
+        """
+        Commits the batches whose lines are all in searches delivered
+        :raise RuntimeError: when a search was not delivered
+        """
+        from confluent_kafka import TopicPartition
+
+        if self.failed:
+            # the input is consumed again on restart
+            raise RuntimeError(
+                f"{self.failed} searches not delivered: offsets are not committed"
+            )
+        first_in_flight = self.first_line_in_flight()
+        committable = 0
+        for _, last_line in self.uncommitted:
+            if first_in_flight is not None and last_line >= first_in_flight:
+                break
+            committable += 1
+        if not committable:
+            return
+        # later batches have higher offsets: merging all the committable ones
+        to_commit = {}
+        for _ in range(committable):
+            to_commit.update(self.uncommitted.popleft()[0])
+        self.consumer.commit(
+            offsets=[
+                TopicPartition(topic, partition, offset)
+                for (topic, partition), offset in to_commit.items()
+            ],
+            asynchronous=False,
+        )
+
+    def close(self):
+        """
+        Commits the lines of the searches delivered, then closes the consumer
+        :raise RuntimeError: when a search was not delivered
+        """
+        try:
+            self.commit()
+        finally:
+            self.consumer.close()
+
+
+# Kafka producer
+def create_producer():
+    """
+    :return producer: Kafka producer batching the messages
     """
+    from confluent_kafka import Producer
+
     conf = {
         "bootstrap.servers": KAFKA_BROKER,
+        "linger.ms": KAFKA_LINGER_MS,
+        "batch.size": KAFKA_BATCH_SIZE,
+        "compression.type": KAFKA_COMPRESSION,
     }
-    producer = Producer(conf)
+    return Producer(conf)
+
 
+def produce_to_kafka(
+    data_generator, encoder=None, producer=None, stats=None, on_delivered=None
+):
+    """
+    Function to produce JSON data to a Kafka topic.
+    Messages are batched by the producer (linger, batch size, compression) and only
+    flushed once at the end. Delivery reports are served by periodic poll() calls.
+
+    Parameters:
+        - data_generator: iterator on searches to be sent to Kafka.
+        - encoder: function encoding a search, to str or bytes (default: compact json).
+        - producer: Kafka producer (default: created by create_producer).
+        - stats: Counter to update (default: a new one).
+        - on_delivered: function called with the number (from 0, in production order)
+          and the error (None when delivered) of each message.
+    :return stats: Counter with produced/delivered/failed messages and delivery latencies
+    """
+    if producer is None:
+        producer = create_producer()
+    if stats is None:
+        stats = Counter()
+
+    def on_delivery(produced_at, number):
+        def callback(err, msg):
+            latency = time.time() - produced_at
+            if err is not None:
+                stats["delivery_failed"] += 1
+                logger.error("Failed to deliver message: %s" % err)
+            else:
+                stats["delivered"] += 1
+                stage_seconds.observe("produce", latency)
+                stats["delivery_latency_ms_sum"] += latency * 1000
+                stats["delivery_latency_ms_max"] = max(
+                    stats["delivery_latency_ms_max"], latency * 1000
+                )
+            if on_delivered is not None:
+                on_delivered(number, err)
+
+        return callback
+
+    def produce(value):
+        while True:
+            try:
+                producer.produce(
+                    KAFKA_OUTPUT_TOPIC,
+                    value,
+                    on_delivery=on_delivery(time.time(), stats["produced"]),
+                )
+                return
+            except BufferError:
+                # local queue is full: wait for some deliveries
+                producer.poll(1.0)
+
+    events.track(
+        "producer", stats, keys=("produced", "delivered", "delivery_failed")
+    )
     try:
         for data in data_generator:
-            producer.produce(
-                KAFKA_OUTPUT_TOPIC, json.dumps(data, indent=2).encode("utf-8")
-            )
-            producer.flush()
+            start = time.perf_counter()
+            value = encoder(data) if encoder else jsonCodec.dumps(data)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            stage_seconds.observe("encode", time.perf_counter() - start)
+            produce(value)
+            stats["produced"] += 1
+            # serves the delivery callbacks, does not block
+            producer.poll(0)
+            queue_depth.set("producer", len(producer))
+            if stats["produced"] % 1000 == 0:
+                logger.info(f"Producer: %s" % stats)
     except Exception as e:
-        print("Failed to send message to Kafka topic:", e)
+        logger.exception("Failed to send message to Kafka topic: %s" % e)
+    finally:
+        remaining = producer.flush(KAFKA_FLUSH_TIMEOUT)
+        if remaining > 0:
+            stats["delivery_failed"] += remaining
+            logger.error(f"{remaining} messages not delivered at shutdown")
+        if stats["delivered"] > 0:
+            stats["delivery_latency_ms_avg"] = round(
+                stats["delivery_latency_ms_sum"] / stats["delivered"], 2
+            )
+        logger.info(f"Producer finished: %s" % stats)
+    return stats
 
 
 # geography module
@@ -145,45 +525,132 @@ def get_neob():
     return neob
 
 
-# Currency rates
-def load_rates(rates_file):
+geo = None
+
+
+def get_geo():
     """
-    Decodes currency rate file as provided by the BCE from https://www.ecb.europa.eu/stats/eurofxref/eurofxref.zip
-    :param: rates_file: name of the rates CSV file
-    :return: rates: dict currency code -> rate
+    Inits the geography cache if necessary
+    :return: geo: GeoCache or GeoMatrix object to be used for cached geo lookups
     """
+    global geo
+    if geo is None:
+        if GEO_MATRIX_FILE:
+            # neobase is only loaded for codes missing from the precomputed file
+            logger.info("Loading geo matrix %s" % GEO_MATRIX_FILE)
+            geo = geoMatrix.GeoMatrix(
+                GEO_MATRIX_FILE, fallback=lambda: geoCache.GeoCache(get_neob())
+            )
+        else:
+            geo = geoCache.GeoCache(get_neob())
+    return geo
 
-    header = None
-    rates = []
-    with open(rates_file, "r") as f:
-        for line in f:
-            array = line.rstrip().split(",")
-            if len(array) <= 1:
-                return None  # skip empty line
-            array = [
-                x.lstrip() for x in array if x != ""
-            ]  # removing heading white spaces
-            if header == None:
-                # first line is the header: Date, USD, JPY, BGN, CZK, DKK, ...
-                header = array
+
+geo_cache.track("geo", lambda: geo.stats() if geo is not None else {})
+
+
+def merge_geo_stats(stats):
+    """
+    :param stats: iterable on geography stats dicts, one per process
+    :return: dict with the sums of the counters and sizes, the matrix is shared
+    """
+    merged = Counter()
+    for process_stats in stats:
+        for key, value in process_stats.items():
+            if key == "matrix_size":
+                merged[key] = max(merged[key], value)
             else:
-                # next lines are date and rates: 19 November 2021, 1.1271, 128.22, 1.9558, 25.413, 7.4366, ...
-                # convert date into reasonable format
-                rate_date = datetime.datetime.strptime(array[0], "%d %B %Y").strftime(
-                    "%Y-%m-%d"
-                )
-                # convert next fields to float
-                array = [rate_date] + list(map(float, array[1:]))
-                # zip with header
-                rates.append(dict(zip(header, array)))
-
-    # only returns the last date for this simple version
-    rates = rates[-1]
-    logger.info("Currency rates loaded: %s" % rates)
+                merged[key] += value
+    return dict(merged)
+
+
+# Currency rates
+
+
+def load_rates(rates_file, reload_interval=0):
+    """
+    Loads a currency rate file as provided by the BCE, daily from https://www.ecb.europa.eu/stats/eurofxref/eurofxref.zip
+    or full history from https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip
+    :param: rates_file: name of the rates CSV file
+    :param reload_interval: seconds between two checks of the file, 0 never reloads
+    :return: rates: currencyRates.RateStore, rates by currency and date
+    """
+    rates = currencyRates.RateStore(rates_file, reload_interval)
+    table = rates.table
+    logger.info(
+        "Currency rates loaded from %s to %s: %s"
+        % (table.first_date, table.last_date, table.latest())
+    )
     return rates
 
 
 # CSV decoding
+_RECO_FIELDS_NB = len(_RECO_LAYOUT)
+_FLIGHT_FIELDS_NB = len(_FLIGHT_LAYOUT)
+_NB_OF_FLIGHTS_INDEX = _RECO_LAYOUT.index("nb_of_flights")
+# decoding functions compiled from the layouts, per number of flights
+_decode_plans = {}
+_MAX_COMPILED_FLIGHTS = 32
+
+
+def _compile_plan(nb_of_flights):
+    """
+    Generates the function building a reco with nb_of_flights flights from its fields:
+    a dict display per reco and flight, with the field indexes as constants.
+    Dict displays are about a third faster than dicts built from zip or itemgetter.
+    The source is registered in linecache, so that it shows in tracebacks and debuggers.
+    :param nb_of_flights: number of flights of the recos
+    :return: function taking the list of fields and returning the reco dict
+    """
+    name = f"decode_{nb_of_flights}_flights"
+    lines = [f"def {name}(a):", "    return {"]
+    for i, field in enumerate(_RECO_LAYOUT):
+        value = nb_of_flights if field == "nb_of_flights" else f"a[{i}]"
+        lines.append(f"        {field!r}: {value},")
+    lines.append("        'flights': [")
+    end = _RECO_FIELDS_NB + nb_of_flights * _FLIGHT_FIELDS_NB
+    for start in range(_RECO_FIELDS_NB, end, _FLIGHT_FIELDS_NB):
+        fields = ", ".join(
+            f"{field!r}: a[{start + i}]" for i, field in enumerate(_FLIGHT_LAYOUT)
+        )
+        lines.append(f"            {{{fields}}},")
+    lines += ["        ],", "    }", ""]
+    source = "\n".join(lines)
+
+    filename = f"<recoReader {name}>"
+    # no modification time: linecache.checkcache keeps the entry
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+    namespace = {}
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace[name]
+
+
+def _decode_fields(array):
+    """
+    Builds a reco from the fields of a CSV line
+    :param array: list of fields
+    :return reco: dict with decoded CSV fields
+    :raise ValueError: when the number of fields does not match nb_of_flights
+    """
+    nb_of_flights = int(array[_NB_OF_FLIGHTS_INDEX])
+    end = _RECO_FIELDS_NB + nb_of_flights * _FLIGHT_FIELDS_NB
+    if nb_of_flights < 0 or len(array) < end:
+        raise ValueError(f"{len(array)} fields for {nb_of_flights} flights")
+
+    plan = _decode_plans.get(nb_of_flights)
+    if plan is None:
+        if nb_of_flights > _MAX_COMPILED_FLIGHTS:
+            reco = dict(zip(_RECO_LAYOUT, array))
+            reco["nb_of_flights"] = nb_of_flights
+            reco["flights"] = [
+                dict(zip(_FLIGHT_LAYOUT, array[start : start + _FLIGHT_FIELDS_NB]))
+                for start in range(_RECO_FIELDS_NB, end, _FLIGHT_FIELDS_NB)
+            ]
+            return reco
+        plan = _decode_plans[nb_of_flights] = _compile_plan(nb_of_flights)
+    return plan(array)
+
+
 def decode_line(line):
     """
     Decodes a CSV line based on _RECO_LAYOUT and _FLIGHT_LAYOUT
@@ -202,25 +669,45 @@ def decode_line(line):
             logger.warning("Empty line")
             return None  # skip empty line
 
-        # decoding fields prior to flight details
-        reco = dict(zip(_RECO_LAYOUT, array))
-        read_columns_nb = len(_RECO_LAYOUT)
+        return _decode_fields(array)
 
-        # convert to integer
-        reco["nb_of_flights"] = int(reco["nb_of_flights"])
-
-        # decoding flights details
-        reco["flights"] = []
-        for i in range(0, reco["nb_of_flights"]):
-            flight = dict(zip(_FLIGHT_LAYOUT, array[read_columns_nb:]))
-            read_columns_nb += len(_FLIGHT_LAYOUT)
-            reco["flights"].append(flight)
-
-    except:
-        logger.exception("Failed at decoding CSV line: %s" % line.rstrip())
+    except (ValueError, IndexError) as e:
+        logger.warning("Failed at decoding CSV line (%s): %s" % (e, line.rstrip()))
         return None
 
-    return reco
+
+def decode_lines(lines, cnt, stopwatch=None):
+    """
+    Decodes CSV lines, counting the bad lines instead of logging them
+    :param lines: iterator on raw CSV lines
+    :param cnt: Counter updated with read lines (reco_read), empty and malformed lines
+    :param stopwatch: metrics.Stopwatch accumulating the decoding time (optional)
+    :return recos: iterator on dicts with decoded CSV fields, None for None lines
+                   (no line came from Kafka for a while)
+    """
+    for line in lines:
+        if line is None:
+            yield None
+            continue
+        cnt["reco_read"] += 1
+        if stopwatch is not None:
+            start = time.perf_counter()
+        try:
+            if isinstance(line, bytes):
+                line = line.decode()
+            array = line.rstrip().split("^")
+            if len(array) <= 1:
+                cnt["empty_line"] += 1
+                continue
+            reco = _decode_fields(array)
+        except (ValueError, IndexError):
+            # UnicodeDecodeError is a ValueError
+            cnt["malformed_line"] += 1
+            continue
+        finally:
+            if stopwatch is not None:
+                stopwatch.seconds += time.perf_counter() - start
+        yield reco
 
 
 # Reco processing
@@ -239,11 +726,11 @@ _SEARCH_FIELDS = [
 ]
 
 
-def group_and_decorate(recos_in, rates):
+def build_search(recos_in):
     """
-    Groups recos to build a search object. Adds interesting fields.
+    Groups recos to build a search object. Adds search level fields.
     :param recos_in: set of dict (decoded travel recommendations belonging to the same search)
-    :return search: decorated dict describing a search
+    :return search: dict describing a search, recos are not decorated yet
     """
 
     # don't decorate empty search or empty recos
@@ -251,12 +738,6 @@ def group_and_decorate(recos_in, rates):
         return None
     recos = [reco for reco in recos_in if reco is not None]
 
-    def to_euros(amount):
-        if search["currency"] == "EUR":
-            return amount
-        else:
-            return round(amount / rates[search["currency"]], 2)
-
     try:
         # some fields are common to the search, others are specific to recos
         # taking search fields from the first reco
@@ -270,21 +751,19 @@ def group_and_decorate(recos_in, rates):
         ]
 
         # advance purchase & stay duration & OW/RT
-        search_date = datetime.datetime.strptime(search["search_date"], "%Y-%m-%d")
-        request_dep_date = datetime.datetime.strptime(
-            search["request_dep_date"], "%Y-%m-%d"
-        )
+        request_dep_day = isoDates.day_number(search["request_dep_date"])
         # approximate since the dep date is local to the origin city (whereas the search date is UTC)
-        search["advance_purchase"] = (request_dep_date - search_date).days
+        search["advance_purchase"] = request_dep_day - isoDates.day_number(
+            search["search_date"]
+        )
         if search["request_return_date"] == "":
             search["stay_duration"] = -1
             search["trip_type"] = "OW"  # One Way trip
         else:
-            request_return_date = datetime.datetime.strptime(
-                search["request_return_date"], "%Y-%m-%d"
-            )
             # approximative since the return date is local to the destination city
-            search["stay_duration"] = (request_return_date - request_dep_date).days
+            search["stay_duration"] = (
+                isoDates.day_number(search["request_return_date"]) - request_dep_day
+            )
             search["trip_type"] = "RT"  # Round trip
 
         # decoding passengers string: "ADT=1,CH=2" means 1 Adult and 2 children
@@ -297,10 +776,8 @@ def group_and_decorate(recos_in, rates):
         search["passengers"] = passengers
 
         # countries
-        search["origin_country"] = get_neob().get(search["origin_city"], "country_code")
-        search["destination_country"] = get_neob().get(
-            search["destination_city"], "country_code"
-        )
+        search["origin_country"] = get_geo().country(search["origin_city"])
+        search["destination_country"] = get_geo().country(search["destination_city"])
         # geo: D=Domestic I=International
         search["geo"] = (
             "D" if search["origin_country"] == search["destination_country"] else "I"
@@ -308,8 +785,8 @@ def group_and_decorate(recos_in, rates):
 
         # OnD (means Origin and Destination. E.g. "PAR-NYC")
         search["OnD"] = f"{search['origin_city']}-{search['destination_city']}"
-        search["OnD_distance"] = round(
-            get_neob().distance(search["origin_city"], search["destination_city"])
+        search["OnD_distance"] = get_geo().distance(
+            search["origin_city"], search["destination_city"]
         )
 
     except:
@@ -317,6 +794,33 @@ def group_and_decorate(recos_in, rates):
         # filter out recos when we fail at decorating them
         return None
 
+    return search
+
+
+def group_and_decorate(recos_in, rates):
+    """
+    Groups recos to build a search object. Adds interesting fields.
+    :param recos_in: set of dict (decoded travel recommendations belonging to the same search)
+    :return search: decorated dict describing a search
+    """
+
+    search = build_search(recos_in)
+    if search is None:
+        return None
+
+    # rate of the search day, read once so that a reload does not split the search
+    try:
+        rate = rates.rate(search["currency"], search["search_date"])
+    except (KeyError, ValueError):
+        logger.exception("Failed at converting prices of search: %s" % search)
+        return None
+
+    def to_euros(amount):
+        if search["currency"] == "EUR":
+            return amount
+        else:
+            return round(amount / rate, 2)
+
     # reco decoration
     for reco in search["recos"]:
 
@@ -335,12 +839,10 @@ def group_and_decorate(recos_in, rates):
             # flight decoration
             for f in reco["flights"]:
                 # getting cities (a city can have several airports like PAR has CDG and ORY)
-                f["dep_city"] = get_neob().get(f["dep_airport"], "city_code_list")[0]
-                f["arr_city"] = get_neob().get(f["arr_airport"], "city_code_list")[0]
+                f["dep_city"] = get_geo().city(f["dep_airport"])
+                f["arr_city"] = get_geo().city(f["arr_airport"])
 
-                f["distance"] = round(
-                    get_neob().distance(f["dep_airport"], f["arr_airport"])
-                )
+                f["distance"] = get_geo().distance(f["dep_airport"], f["arr_airport"])
                 reco["flown_distance"] += f["distance"]
                 marketing_airlines[f["marketing_airline"]] = (
                     marketing_airlines.get(f["marketing_airline"], 0) + f["distance"]
@@ -374,11 +876,15 @@ def group_and_decorate(recos_in, rates):
 
 
 def encoder_json(search):
-    return json.dumps(search)
+    return jsonCodec.dumps(search)
 
 
 def encoder_pretty_json(search):
-    return json.dumps(search, indent=2)
+    return jsonCodec.dumps_pretty(search)
+
+
+def encoder_compact(search):
+    return compactCodec.encode(search)
 
 
 def encoder_test(search):
@@ -389,46 +895,352 @@ def encoder_test(search):
 encoders = {
     "json": encoder_json,
     "pretty_json": encoder_pretty_json,
+    "compact": encoder_compact,
     "test": encoder_test,
 }
 
 
+# Input sources
+def read_lines(args, kafka_input=None):
+    """
+    Selects the input source: the input file when one is given, Kafka otherwise
+    :param args: script arguments
+    :param kafka_input: KafkaInput consuming by batches (default: one message per poll)
+    :return lines: iterator on raw CSV lines
+    """
+    input_file = getattr(args, "input_file", None)
+    if input_file is None:
+        if kafka_input is not None:
+            return kafka_input.lines()
+        return process_kafka_messages()
+    return process_input_file(input_file)
+
+
+def kafka_pipeline(args, encoder):
+    """
+    Consumes CSV lines from Kafka and produces the decorated searches to Kafka.
+    Consumed offsets are only committed once the searches built from them are delivered.
+    :param args: script arguments
+    :param encoder: function encoding a search
+    :return stats: producer stats
+    """
+    producer = create_producer()
+    stats = Counter()
+    batch_size = getattr(args, "consume_batch_size", KAFKA_CONSUME_BATCH_SIZE)
+    if batch_size <= 0:
+        # one poll() per message, with auto commit
+        return produce_to_kafka(process(args), encoder, producer, stats)
+    kafka_input = KafkaInput(batch_size)
+    try:
+        return produce_to_kafka(
+            process(args, kafka_input),
+            encoder,
+            producer,
+            stats,
+            kafka_input.acknowledge,
+        )
+    finally:
+        # after the producer flush: commits the lines of the searches delivered
+        kafka_input.close()
+
+
+# Grouping
+class SearchWindow:
+    """
+    Searches being grouped, least recently updated first
+    """
+
+    def __init__(
+        self,
+        idle_timeout=GROUP_IDLE_TIMEOUT,
+        max_searches=GROUP_MAX_SEARCHES,
+        max_recos=GROUP_MAX_RECOS,
+    ):
+        """
+        :param idle_timeout: seconds after the last reco of a search to flush it
+        :param max_searches: max number of open searches
+        :param max_recos: max number of buffered recos, over all the open searches
+        """
+        self.idle_timeout = idle_timeout
+        self.max_searches = max_searches
+        self.max_recos = max_recos
+        # search_id -> [recos, time of the last reco, number of the first line]
+        self.searches = OrderedDict()
+        self.recos = 0
+        # no search is idle before this time: expire is skipped until then
+        self.next_expiry = float("inf")
+        self.last_id = None
+        self.last_search = None
+        # recently flushed search_ids, to count the recos coming after their search
+        self.flushed = deque()
+        self.flushed_ids = set()
+
+    def add(self, reco, line_number, now, cnt):
+        """
+        :param reco: decoded reco
+        :param line_number: number of the line of the reco in the input
+        :param now: time.monotonic()
+        :param cnt: Counter updated with the late recos and the evicted searches
+        :return groups: list of the searches flushed, as (number of the first line, recos)
+        """
+        search_id = reco["search_id"]
+        if search_id == self.last_id:
+            # consecutive recos of the last updated search: already at the end
+            search = self.last_search
+            search[0].append(reco)
+            search[1] = now
+            self.recos += 1
+            if self.recos <= self.max_recos and now <= self.next_expiry:
+                return []
+            return self._evict(now, cnt)
+
+        search = self.searches.get(search_id)
+        if search is None:
+            if search_id in self.flushed_ids:
+                # the search was already flushed: it will be split
+                cnt["reco_late"] += 1
+            if not self.searches:
+                self.next_expiry = now + self.idle_timeout
+            search = self.searches[search_id] = [[reco], now, line_number]
+        else:
+            search[0].append(reco)
+            search[1] = now
+            self.searches.move_to_end(search_id)
+        self.recos += 1
+        self.last_id = search_id
+        self.last_search = search
+        return self._evict(now, cnt)
+
+    def _evict(self, now, cnt):
+        groups = self.expire(now) if now > self.next_expiry else []
+        while len(self.searches) > self.max_searches or self.recos > self.max_recos:
+            cnt["search_evicted"] += 1
+            groups.append(self._pop())
+        return groups
+
+    def expire(self, now):
+        """
+        :param now: time.monotonic()
+        :return groups: list of the searches idle for more than idle_timeout, as
+                        (number of the first line, recos)
+        """
+        groups = []
+        deadline = now - self.idle_timeout
+        while self.searches:
+            last_update = next(iter(self.searches.values()))[1]
+            if last_update >= deadline:
+                # searches are sorted by last update: the others are not idle either
+                self.next_expiry = last_update + self.idle_timeout
+                break
+            groups.append(self._pop())
+        else:
+            self.next_expiry = float("inf")
+        return groups
+
+    def flush(self):
+        """
+        :return groups: list of all the open searches, as (number of the first line, recos)
+        """
+        return [self._pop() for _ in range(len(self.searches))]
+
+    def first_line(self):
+        """
+        :return: number of the first line still buffered, None if none
+        """
+        return min((search[2] for search in self.searches.values()), default=None)
+
+    def _pop(self):
+        search_id, (recos, _, first_line) = self.searches.popitem(last=False)
+        if search_id == self.last_id:
+            self.last_id = None
+        self.recos -= len(recos)
+        self.flushed.append(search_id)
+        self.flushed_ids.add(search_id)
+        if len(self.flushed) > self.max_searches:
+            self.flushed_ids.discard(self.flushed.popleft())
+        return first_line, recos
+
+
+def group_recos(lines, cnt, window=None):
+    """
+    Decodes CSV lines and groups the recos with the same search_id, see SearchWindow
+    :param lines: iterator on raw CSV lines
+    :param cnt: Counter updated with read/decoded recos, bad lines and read searches
+    :param window: SearchWindow holding the searches being grouped (default: a new one)
+    :return groups: iterator on lists of recos belonging to the same search
+    """
+    for _, recos in group_searches(lines, cnt, window):
+        yield recos
+
+
+def group_searches(lines, cnt, window=None):
+    """
+    Same as group_recos, with the number of the first line of each search
+    :param lines: iterator on raw CSV lines
+    :param cnt: Counter updated with read/decoded recos, bad lines and read searches
+    :param window: SearchWindow holding the searches being grouped (default: a new one)
+    :return groups: iterator on (number of the first line, recos of the same search)
+    """
+    if window is None:
+        window = SearchWindow()
+    # decoding time of each search, without the time spent waiting for the lines
+    stopwatch = metrics.Stopwatch()
+    observed = 0.0
+    for reco in decode_lines(lines, cnt, stopwatch):
+        if reco is None:
+            groups = window.expire(time.monotonic())
+        else:
+            cnt["reco_decoded"] += 1
+            groups = window.add(reco, cnt["reco_read"], time.monotonic(), cnt)
+        for first_line, recos in groups:
+            if cnt["search_read"] % 1000 == 0:
+                # log every 1000 searches to show the script is alive
+                logger.info(f"Running: %s" % cnt)
+            cnt["search_read"] += 1
+            # time spent decoding since the previous search
+            stage_seconds.observe("decode", stopwatch.seconds - observed)
+            observed = stopwatch.seconds
+            queue_depth.set("grouping_searches", len(window.searches))
+            queue_depth.set("grouping_recos", window.recos)
+            yield first_line, recos
+    # end of the input, or shutdown: flushing the searches being grouped
+    for first_line, recos in window.flush():
+        cnt["search_read"] += 1
+        stage_seconds.observe("decode", stopwatch.seconds - observed)
+        observed = stopwatch.seconds
+        yield first_line, recos
+
+
+# Decoration pool
+# Each search group is decorated by a worker process. Workers get the rates once, at
+# startup, and return the search with their own stats and the stats of their
+# geography cache.
+_worker_rates = None
+
+
+def _init_worker(rates):
+    global _worker_rates
+    _worker_rates = rates
+    # each worker reloads the rates file on its own
+    rates.watch()
+
+
+def _decorate_in_worker(recos):
+    start = time.perf_counter()
+    search = group_and_decorate(recos, _worker_rates)
+    stats = Counter(decorate_seconds=time.perf_counter() - start)
+    if search:
+        stats["search_encoded"] += 1
+    else:
+        stats["search_failed"] += 1
+    # geography cache of this worker, merged by the main process
+    geo_stats = (os.getpid(), geo.stats() if geo is not None else {})
+    return search, stats, geo_stats
+
+
+def decorate_in_pool(groups, rates, workers, max_in_flight, ordered=True):
+    """
+    Decorates search groups in a pool of processes
+    :param groups: iterator on (number of the first line, recos of the same search)
+    :param rates: rates by currency and date (currencyRates.RateStore)
+    :param workers: number of worker processes
+    :param max_in_flight: max number of groups sent to the workers and not returned yet
+    :param ordered: whether searches are returned in input order
+    :return results: iterator on (number of the first line, search, worker stats,
+                     (worker pid, geography stats))
+    """
+    # future -> number of the first line of the group
+    first_lines = {}
+
+    def returned(future):
+        return (first_lines.pop(future),) + future.result()
+
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(rates,)
+    ) as pool:
+        pending = deque()
+        for first_line, recos in groups:
+            if ordered:
+                # returning what is ready at the head without blocking
+                while pending and pending[0].done():
+                    yield returned(pending.popleft())
+                if len(pending) >= max_in_flight:
+                    yield returned(pending.popleft())
+            elif len(pending) >= max_in_flight:
+                done, not_done = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                pending = deque(not_done)
+                for future in done:
+                    yield returned(future)
+            future = pool.submit(_decorate_in_worker, recos)
+            first_lines[future] = first_line
+            pending.append(future)
+            queue_depth.set("decoration_pool", len(pending))
+
+        if ordered:
+            for future in pending:
+                yield returned(future)
+        else:
+            for future in concurrent.futures.as_completed(pending):
+                yield returned(future)
+
+
 # Main function
-def process(args):
+def process(args, kafka_input=None):
     """
     Main process: reads, decodes, groups into search and decorates
     :param args: script arguments
+    :param kafka_input: KafkaInput consuming by batches (default: see read_lines)
     :return searches: iterator on search objects (returned with yield)
     """
     start = time.time()
     cnt = Counter()
-    rates = load_rates(args.rates_file)
+    rates = load_rates(args.rates_file, getattr(args, "rates_reload", 0))
+    rates.watch()
+    workers = getattr(args, "workers", 1)
 
     logger.info("Decoding/encoding")
 
-    recos = []
-    current_search_id = 0
-    for line in process_kafka_messages():
-        cnt["reco_read"] += 1
-        reco = decode_line(line)
-        if reco:
-            cnt["reco_decoded"] += 1
-            # new search_id means new search: we can process the collected recos
-            if reco["search_id"] != current_search_id:
-                current_search_id = reco["search_id"]
-                if len(recos) > 0:
-                    if cnt["search_read"] % 1000 == 0:
-                        # log every 1000 searches to show the script is alive
-                        logger.info(f"Running: %s" % cnt)
-                    cnt["search_read"] += 1
-                    search = group_and_decorate(recos, rates)
-                    if search:
-                        cnt["search_encoded"] += 1
-                        yield search
-                    recos = []
-            recos.append(reco)
+    events.track("process", cnt)
+    window = SearchWindow(GROUP_IDLE_TIMEOUT, GROUP_MAX_SEARCHES, GROUP_MAX_RECOS)
+    groups = group_searches(read_lines(args, kafka_input), cnt, window)
+    if kafka_input is not None:
+        # the Kafka offsets of the lines not delivered yet are not committed
+        kafka_input.window = window
+        groups = kafka_input.track(groups)
+    if workers > 1:
+        max_in_flight = getattr(args, "max_in_flight", None) or 4 * workers
+        ordered = not getattr(args, "unordered", False)
+        logger.info(f"Decorating with {workers} workers")
+        worker_geo = {}
+        geo_cache.track("geo", lambda: merge_geo_stats(worker_geo.values()))
+        for first_line, search, stats, (pid, geo_stats) in decorate_in_pool(
+            groups, rates, workers, max_in_flight, ordered
+        ):
+            stage_seconds.observe("decorate", stats.pop("decorate_seconds"))
+            cnt.update(stats)
+            worker_geo[pid] = geo_stats
+            if kafka_input is not None:
+                kafka_input.hand_over(first_line, search)
+            if search:
+                yield search
+    else:
+        for first_line, recos in groups:
+            with stage_seconds.time("decorate"):
+                search = group_and_decorate(recos, rates)
+            if kafka_input is not None:
+                kafka_input.hand_over(first_line, search)
+            if search:
+                cnt["search_encoded"] += 1
+                yield search
     end = time.time()
-    print(f"Finished in {round(end - start, 2)} seconds: {cnt}")
+    # logged rather than printed: standard output carries the encoded searches in file mode
+    logger.info(f"Finished in {round(end - start, 2)} seconds: {cnt}")
+    if workers > 1:
+        logger.info("Geography cache: %s" % merge_geo_stats(worker_geo.values()))
+    elif geo is not None:
+        logger.info("Geography cache: %s" % geo.stats())
 
 
 if __name__ == "__main__":
@@ -438,7 +1250,11 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Travel data reader")
     parser.add_argument(
-        "input_file", help="Data file to read (gziped csv file)", nargs="?", default="-"
+        "input_file",
+        help="Data file to read (gziped or plain csv file, - for standard input). "
+        "Default is to consume from Kafka.",
+        nargs="?",
+        default=None,
     )
     parser.add_argument(
         "-f",
@@ -453,10 +1269,57 @@ if __name__ == "__main__":
         help=f"Data file with currency rates. Default is {def_rates_file}",
         default=def_rates_file,
     )
+    parser.add_argument(
+        "--rates_reload",
+        help="Seconds between two checks of the rates file, reloaded when it changes, "
+        f"0 to never reload. Default is {currencyRates.RATES_RELOAD_INTERVAL}.",
+        type=float,
+        default=currencyRates.RATES_RELOAD_INTERVAL,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of decoration processes. Default is 1 (no pool).",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        help="Max number of searches being decorated by the pool. Default is 4 per worker.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--unordered",
+        help="Output searches as soon as they are decorated, not in input order.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-b",
+        "--consume_batch_size",
+        help="Number of Kafka messages consumed at once, 0 to poll them one by one. "
+        f"Default is {KAFKA_CONSUME_BATCH_SIZE}.",
+        type=int,
+        default=KAFKA_CONSUME_BATCH_SIZE,
+    )
     arguments = parser.parse_args()
 
     encoder = encoders[arguments.format]
 
-    process(arguments)
-
-    produce_to_kafka(process(arguments))
+    if arguments.input_file is None:
+        # stops consuming, then flushes the searches being grouped and the producer
+        signal.signal(signal.SIGTERM, lambda signum, frame: shutdown.set())
+        metrics.start_http_server(METRICS_PORT)
+        kafka_pipeline(arguments, encoder)
+    else:
+        out = sys.stdout.buffer
+        for search in process(arguments):
+            value = encoder(search)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            if encoder is encoder_compact:
+                # binary searches can contain new lines: length prefixed instead
+                compactCodec.write_frame(out, value)
+            else:
+                out.write(value + b"\n")
+        out.flush()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Currency rates unit tests
+
+> pytest
+
+"""
+
+import os
+
+import pytest
+
+from currencyRates import RateStore, read_table
+
+rates_file = os.path.join(os.path.dirname(__file__), "etc/eurofxref.csv")
+
+# history file layout: newest first, N/A for currencies not quoted that day
+HISTORY = """Date,USD,JPY,CYP,
+2021-11-22,1.1250,128.80,N/A,
+2021-11-19,1.1271,128.22,N/A,
+2021-11-18,1.1323,129.34,0.5780,
+"""
+
+
+def test_daily_file():
+
+    table = read_table(rates_file)
+    assert table.first_date == table.last_date
+    # any date gets the rates of the file
+    assert table.rate("USD", "2021-11-19") == 1.1271
+    assert table.rate("USD", "2020-01-01") == 1.1271
+    assert table.rate("EUR", "2021-11-19") == 1.0
+    with pytest.raises(KeyError):
+        table.rate("XXX", "2021-11-19")
+
+
+def test_history_file(tmp_path):
+
+    history_file = tmp_path / "eurofxref-hist.csv"
+    history_file.write_text(HISTORY)
+    table = read_table(history_file)
+
+    assert table.rate("USD", "2021-11-18") == 1.1323
+    # week-end: rates of the friday
+    assert table.rate("USD", "2021-11-20") == 1.1271
+    assert table.rate("JPY", "2021-11-21") == 128.22
+    assert table.rate("USD", "2021-11-22") == 1.125
+    # out of the file range
+    assert table.rate("USD", "2021-01-01") == 1.1323
+    assert table.rate("USD", "2022-01-01") == 1.125
+    # not quoted anymore: last known rate
+    assert table.rate("CYP", "2021-11-22") == 0.578
+    assert table.latest() == {"USD": 1.125, "JPY": 128.8, "CYP": 0.578}
+
+
+def test_reload(tmp_path):
+
+    history_file = tmp_path / "eurofxref-hist.csv"
+    history_file.write_text(HISTORY)
+    rates = RateStore(history_file, reload_interval=0)
+    assert not rates.reload()
+
+    table = rates.table
+    history_file.write_text(HISTORY.replace("2021-11-22,1.1250", "2021-11-22,1.2000"))
+    os.utime(history_file, ns=(0, 0))
+    assert rates.reload()
+    assert rates.table is not table
+    assert rates.rate("USD", "2021-11-22") == 1.2
+    # the former table is left unchanged
+    assert table.rate("USD", "2021-11-22") == 1.125
+
+    # a bad file keeps the current rates
+    history_file.write_text("Date,USD,\n")
+    os.utime(history_file, ns=(1, 1))
+    with pytest.raises(ValueError):
+        rates.reload()
+    assert rates.rate("USD", "2021-11-22") == 1.2
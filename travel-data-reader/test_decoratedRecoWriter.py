@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Writer unit test
+
+> pytest
+
+"""
+
+import csv
+import io
+import json
+import os
+from datetime import date, datetime
+
+import pytest
+
+import decoratedRecoWriter
+import metrics
+from decoratedRecoWriter import (
+    search_to_rows,
+    flush_rows,
+    rollup_counts,
+    price_bin,
+    partition_months,
+    ond_summary,
+    _COLUMNS,
+)
+
+search_filename = os.path.join(os.path.dirname(__file__), "test/search_example1.json")
+
+
+def load_search():
+    with open(search_filename) as f:
+        return json.load(f)
+
+
+def test_search_to_rows():
+
+    search = load_search()
+    rows = search_to_rows(search)
+    assert len(rows) == len(search["recos"])
+
+    row = dict(zip(_COLUMNS, rows[0]))
+    assert row["search_id"] == "LRX-51980-1637149713-8763"
+    assert row["OnD"] == "PAR-LIS"
+    assert row["main_airline"] == "KL"
+    assert row["price_EUR"] == search["recos"][0]["price_EUR"]
+    assert row["search_time"] == datetime(2021, 11, 17, 11, 48, 39)
+    assert row["stay_duration"] == 2
+    assert row["cabin"] == "M"
+
+    # one way
+    search["request_return_date"] = ""
+    search["stay_duration"] = -1
+    assert search_to_rows(search)[0][_COLUMNS.index("stay_duration")] == -1
+
+    # searches decorated without stay_duration: computed from the dates
+    del search["stay_duration"]
+    assert search_to_rows(search)[0][_COLUMNS.index("stay_duration")] == -1
+    search["request_return_date"] = "2021-12-20"
+    assert search_to_rows(search)[0][_COLUMNS.index("stay_duration")] == 3
+
+
+class FakeConnection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.events = []
+        self.copied = None
+
+    def cursor(self):
+        connection = self
+
+        class FakeCursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def copy_expert(self, sql, buffer):
+                if connection.fail:
+                    raise RuntimeError("copy failed")
+                connection.events.append("copy")
+                connection.copied = buffer.read()
+
+            def execute(self, sql, params=None):
+                if "INSERT INTO ingest_watermark" in sql:
+                    connection.events.append("watermark")
+
+        return FakeCursor()
+
+    def commit(self):
+        self.events.append("db commit")
+
+    def rollback(self):
+        self.events.append("db rollback")
+
+
+class FakeConsumer:
+    def __init__(self, events):
+        self.events = events
+
+    def commit(self, asynchronous):
+        self.events.append("kafka commit")
+
+
+def test_flush_rows(monkeypatch):
+
+    rows = search_to_rows(load_search())
+    conn = FakeConnection()
+    monkeypatch.setattr(
+        decoratedRecoWriter,
+        "execute_values",
+        lambda cursor, sql, values: conn.events.append(sql.split()[2]),
+    )
+    flushes = decoratedRecoWriter.stats["flushes"]
+    flush_rows(conn, FakeConsumer(conn.events), rows)
+    # Kafka offsets are only committed after the database
+    assert conn.events == [
+        "copy",
+        "flight_recos_rollup",
+        "ond_catalogue",
+        "watermark",
+        "db commit",
+        "kafka commit",
+    ]
+    copied = list(csv.reader(io.StringIO(conn.copied)))
+    assert len(copied) == len(rows)
+    assert copied[0][0] == "LRX-51980-1637149713-8763"
+    assert copied[0][_COLUMNS.index("search_time")] == "2021-11-17 11:48:39"
+    assert decoratedRecoWriter.stats["flushes"] == flushes + 1
+    exposed = metrics.render()
+    assert 'writer_stage_seconds_bucket{stage="flush",le="+Inf"}' in exposed
+    assert f'writer_events_total{{event="flushes"}} {flushes + 1}' in exposed
+
+    conn = FakeConnection(fail=True)
+    with pytest.raises(RuntimeError):
+        flush_rows(conn, FakeConsumer(conn.events), rows)
+    assert conn.events == ["db rollback"]
+    assert decoratedRecoWriter.stats["flush_errors"] >= 1
+
+
+def test_rollup_counts():
+
+    search = load_search()
+    rows = search_to_rows(search)
+    # a second search with the same buckets
+    search["search_id"] = "other"
+    rows += search_to_rows(search)
+
+    counts = rollup_counts(rows)
+    min_prices = {}
+    for reco in search["recos"]:
+        airline = reco["main_marketing_airline"]
+        min_prices[airline] = min(min_prices.get(airline, reco["price_EUR"]), reco["price_EUR"])
+
+    # one count per search, main airline and cabin ("*" for all cabins)
+    assert sum(counts.values()) == 2 * 2 * len(min_prices)
+    for airline, min_price in min_prices.items():
+        for cabin in ("M", "*"):
+            key = ("PAR-LIS", airline, 30, "RT", cabin, datetime(2021, 11, 17).date())
+            assert counts[key + price_bin(min_price)] == 2
+
+    # bins are about 3% wide
+    bin_number, bin_price = price_bin(386.07)
+    assert abs(bin_price - 386.07) / 386.07 < 0.015
+    assert price_bin(bin_price)[0] == bin_number
+    # no floor on small prices
+    assert price_bin(0.5)[0] < price_bin(0.9)[0] < price_bin(1.0)[0]
+    assert abs(price_bin(0.05)[1] - 0.05) / 0.05 < 0.015
+    assert price_bin(0.0) == price_bin(-1.0) == (decoratedRecoWriter._ROLLUP_FREE_BIN, 0.0)
+
+
+def test_partition_months(monkeypatch):
+
+    monkeypatch.setattr(decoratedRecoWriter, "PG_PARTITIONS_AHEAD", 2)
+    rows = search_to_rows(load_search())
+    # month of the rows, current month and 2 months ahead, over the year end
+    assert partition_months(rows, today=date(2022, 11, 20)) == {
+        date(2021, 11, 1),
+        date(2022, 11, 1),
+        date(2022, 12, 1),
+        date(2023, 1, 1),
+    }
+
+
+def test_ond_summary():
+
+    rows = search_to_rows(load_search())
+    i = _COLUMNS.index("search_time")
+    later = [row[:i] + (datetime(2021, 12, 1),) + row[i + 1 :] for row in rows[:10]]
+    assert ond_summary(rows + later) == {
+        "PAR-LIS": (
+            datetime(2021, 11, 17, 11, 48, 39),
+            datetime(2021, 12, 1),
+            len(rows) + 10,
+        )
+    }
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Geography cache and matrix unit tests
+
+> pytest
+
+"""
+
+import neobase
+
+from geoCache import GeoCache
+from geoMatrix import GeoMatrix, write_matrix
+
+
+def test_geo_cache():
+
+    neob = neobase.NeoBase()
+    geo = GeoCache(neob, distance_cache_size=2)
+
+    assert geo.country("CDG") == "FR"
+    assert geo.city("CDG") == "PAR"
+    assert geo.city("PAR") == "PAR"
+    assert geo.distance("CDG", "AMS") == round(neob.distance("CDG", "AMS"))
+
+    # same pair in the other direction is a hit
+    assert geo.distance("AMS", "CDG") == 398
+    stats = geo.stats()
+    assert stats["record_hits"] == 1
+    assert stats["record_misses"] == 2
+    assert stats["distance_hits"] == 1
+    assert stats["distance_misses"] == 1
+
+    # LRU eviction
+    geo.distance("CDG", "LIS")
+    geo.distance("AMS", "LIS")
+    assert geo.stats()["distance_size"] == 2
+
+
+def test_geo_matrix(tmp_path):
+
+    neob = neobase.NeoBase()
+    matrix_file = str(tmp_path / "geo_matrix.bin")
+    assert write_matrix(matrix_file, ["CDG", "AMS", "LIS", "PAR", "NOTACODE"], neob) == 4
+
+    geo = GeoMatrix(matrix_file, fallback=lambda: GeoCache(neob))
+    assert geo.size == 4
+    assert geo.country("LIS") == "PT"
+    assert geo.city("CDG") == "PAR"
+    assert geo.distance("CDG", "AMS") == 398
+    assert geo.distance("AMS", "CDG") == 398
+    assert geo.distance("PAR", "LIS") == 1447
+    assert geo.distance("CDG", "CDG") == 0
+    assert geo.stats()["matrix_misses"] == 0
+
+    # missing codes go to the fallback
+    assert geo.city("ORY") == "PAR"
+    assert geo.stats()["matrix_misses"] == 1
+    geo.close()
+
+
+def test_geo_matrix_unknown_distance(tmp_path):
+
+    neob = neobase.NeoBase()
+    matrix_file = str(tmp_path / "geo_matrix.bin")
+    lis = neob.get_location("LIS")
+    distance_between_locations = neob.distance_between_locations
+    # distances neobase cannot compute while writing the file
+    neob.distance_between_locations = lambda l1, l2: (
+        None if lis in (l1, l2) else distance_between_locations(l1, l2)
+    )
+    write_matrix(matrix_file, ["CDG", "AMS", "LIS"], neob)
+    del neob.distance_between_locations
+
+    geo = GeoMatrix(matrix_file, fallback=lambda: GeoCache(neob))
+    assert geo.distance("CDG", "AMS") == 398
+    assert geo.stats()["matrix_misses"] == 0
+    # not stored as a distance of 65535 km: asked to neobase
+    assert geo.distance("LIS", "CDG") == round(neob.distance("LIS", "CDG"))
+    assert geo.stats()["matrix_misses"] == 1
+    geo.close()
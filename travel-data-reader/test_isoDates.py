@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+"""
+Date parsing unit tests
+
+> pytest
+
+"""
+
+from datetime import date, datetime
+
+import pytest
+
+from isoDates import parse_date, day_number, parse_timestamp
+
+
+def test_iso_dates():
+
+    assert parse_date("2021-11-17") == date(2021, 11, 17)
+    assert day_number("2021-12-17") - day_number("2021-11-17") == 30
+    assert day_number("2021-03-01") - day_number("2020-02-28") == 367
+    assert parse_timestamp("2021-11-17", "11:48:39") == datetime(2021, 11, 17, 11, 48, 39)
+
+    # same errors as strptime
+    for value in ["", "2021-13-01", "20211117", "17/11/2021"]:
+        with pytest.raises(ValueError):
+            parse_date(value)
+    with pytest.raises(ValueError):
+        parse_timestamp("2021-11-17", "11:48")
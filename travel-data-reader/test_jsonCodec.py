@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+JSON codec unit test
+
+> pytest
+
+"""
+
+import importlib.util
+import json
+
+import pytest
+
+import jsonCodec
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgspec"])
+def test_codec(name):
+
+    if name != "json" and importlib.util.find_spec(name) is None:
+        pytest.skip(f"{name} is not installed")
+    previous = jsonCodec.codec_name
+    try:
+        assert jsonCodec.select_codec(name) == name
+        search = {"search_id": "Q13", "recos": [{"price_EUR": 386.07, "flights": []}]}
+
+        encoded = jsonCodec.dumps(search)
+        assert isinstance(encoded, bytes)
+        assert json.loads(encoded) == search
+        assert jsonCodec.loads(encoded) == search
+        assert jsonCodec.loads(encoded.decode("utf-8")) == search
+        assert json.loads(jsonCodec.dumps_pretty(search)) == search
+        assert b"\n  " in jsonCodec.dumps_pretty(search)
+
+        with pytest.raises(ValueError):
+            jsonCodec.loads(b"not json")
+    finally:
+        jsonCodec.select_codec(previous)
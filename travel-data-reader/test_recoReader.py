@@ -8,9 +8,35 @@ Simple unit test
 """
 
 import os
+import gzip
+import json
+import io
+from collections import Counter
 
+import confluent_kafka
+import pytest
+
+import compactCodec
+import metrics
+import recoReader
+from travelDataGenerator import TravelDataGenerator
 from recoReader import (
-    process
+    process,
+    process_input_file,
+    decode_line,
+    decode_lines,
+    group_recos,
+    SearchWindow,
+    produce_to_kafka,
+    merge_geo_stats,
+    KafkaInput,
+    kafka_pipeline,
+    encoders,
+    _RECO_LAYOUT,
+    _decode_plans,
+    _MAX_COMPILED_FLIGHTS,
+    _FLIGHT_LAYOUT,
+    _SEARCH_FIELDS,
 )
 
 csv_filename = os.path.join(os.path.dirname(__file__), "test/travel_data_example.csv.gz")
@@ -61,6 +87,488 @@ def test_process():
     assert flight["dep_city"] == "PAR"
     assert flight["arr_city"] == "AMS"
     assert flight["distance"] == 398
-    
-    
-    
+
+
+def test_input_file_closed(monkeypatch):
+
+    # keeping references: the files must be closed by the reader, not collected
+    opened = []
+
+    def recording_open(*args, **kwargs):
+        f = open(*args, **kwargs)
+        opened.append(f)
+        return f
+
+    def recording_gzip(fileobj):
+        f = GzipFile(fileobj=fileobj)
+        opened.append(f)
+        return f
+
+    GzipFile = gzip.GzipFile
+    monkeypatch.setattr(recoReader, "open", recording_open, raising=False)
+    monkeypatch.setattr(gzip, "GzipFile", recording_gzip)
+    assert len(list(process_input_file(csv_filename))) == 120
+    # stopped before the end of the file
+    lines = process_input_file(csv_filename)
+    next(lines)
+    lines.close()
+    assert len(opened) == 4
+    assert all(f.closed for f in opened)
+
+
+def test_process_plain_csv(tmp_path):
+
+    # same data, uncompressed
+    plain_csv = tmp_path / "travel_data_example.csv"
+    with gzip.open(csv_filename, "rb") as f:
+        plain_csv.write_bytes(f.read())
+
+    class args:
+        pass
+    args.input_file = str(plain_csv)
+    args.rates_file = rates_file
+
+    searches = list(process(args))
+    assert len(searches) == 2
+    assert [search["search_id"] for search in searches] == [
+        "LRX-51980-1637149713-8763",
+        "Q13-28139-1637149716-312856",
+    ]
+    assert len(searches[1]["recos"]) == 60
+
+
+def test_decode_lines():
+
+    lines = list(process_input_file(csv_filename))
+    bad_lines = [
+        b"\n",
+        b"1.0^Q1^RU\n",  # truncated
+        lines[0].replace(b"^0.00^3^", b"^0.00^x^", 1),  # nb_of_flights not a number
+        lines[0][:-40],  # missing flight fields
+        b"\xff^\xfe\n",  # not utf-8
+    ]
+    cnt = Counter()
+    recos = list(decode_lines(lines + bad_lines, cnt))
+    assert recos == [decode_line(line) for line in lines]
+    assert cnt == {
+        "reco_read": len(lines) + len(bad_lines),
+        "empty_line": 1,
+        "malformed_line": 4,
+    }
+
+
+def test_decode_plans():
+
+    # every number of flights, compiled or not, decodes like zip over the layouts
+    line = next(process_input_file(csv_filename)).decode().rstrip().split("^")
+    reco_fields = line[: len(_RECO_LAYOUT)]
+    flight_fields = line[len(_RECO_LAYOUT) : len(_RECO_LAYOUT) + len(_FLIGHT_LAYOUT)]
+    nb_of_flights_index = _RECO_LAYOUT.index("nb_of_flights")
+    for nb_of_flights in range(_MAX_COMPILED_FLIGHTS + 3):
+        flights = [
+            [f"{value}{n}" for value in flight_fields] for n in range(nb_of_flights)
+        ]
+        array = list(reco_fields)
+        array[nb_of_flights_index] = str(nb_of_flights)
+        for flight in flights:
+            array += flight
+        expected = dict(zip(_RECO_LAYOUT, array))
+        expected["nb_of_flights"] = nb_of_flights
+        expected["flights"] = [dict(zip(_FLIGHT_LAYOUT, flight)) for flight in flights]
+        assert decode_line("^".join(array) + "\n") == expected
+        # extra fields are ignored
+        assert decode_line("^".join(array + ["extra"])) == expected
+
+    # generated source in tracebacks
+    plan = _decode_plans[2]
+    with pytest.raises(IndexError) as error:
+        plan(line[: len(_RECO_LAYOUT) + len(_FLIGHT_LAYOUT) + 2])
+    assert "'dep_airport': a[" in str(error.traceback[-1])
+
+
+def test_process_pool():
+
+    class args:
+        pass
+    args.input_file = csv_filename
+    args.rates_file = rates_file
+    args.workers = 2
+    args.max_in_flight = 1
+
+    # same output, in the same order
+    searches = list(process(args))
+    args.workers = 1
+    assert json.dumps(searches) == json.dumps(list(process(args)))
+
+    args.workers = 2
+    args.unordered = True
+    searches = list(process(args))
+    assert sorted(search["search_id"] for search in searches) == [
+        "LRX-51980-1637149713-8763",
+        "Q13-28139-1637149716-312856",
+    ]
+
+    # geography caches of the workers
+    exposed = dict(
+        line.rsplit(" ", 1)
+        for line in metrics.render().splitlines()
+        if line.startswith("reader_geo_cache{")
+    )
+    assert int(exposed['reader_geo_cache{stat="distance_misses"}']) > 0
+    assert merge_geo_stats(
+        [
+            {"matrix_size": 4, "matrix_misses": 1, "record_hits": 2},
+            {"matrix_size": 4, "matrix_misses": 0},
+        ]
+    ) == {"matrix_size": 4, "matrix_misses": 1, "record_hits": 2}
+
+
+# fake producer: messages are delivered on poll/flush, unless the broker is down, or
+# fail with error
+class FakeProducer:
+    instances = []
+
+    def __init__(self, conf):
+        FakeProducer.instances.append(self)
+        self.conf = conf
+        self.queued = []
+        self.delivered = []
+        self.down = False
+        self.error = None
+        self.flushes = 0
+
+    def produce(self, topic, value, on_delivery):
+        self.queued.append((value, on_delivery))
+
+    def poll(self, timeout):
+        if self.down:
+            return
+        for value, on_delivery in self.queued:
+            if self.error is None:
+                self.delivered.append(value)
+            on_delivery(self.error, value)
+        self.queued = []
+
+    def flush(self, timeout):
+        self.flushes += 1
+        self.poll(timeout)
+        return len(self.queued)
+
+    def __len__(self):
+        return len(self.queued)
+
+
+class FakeMessage:
+    def __init__(self, offset, value):
+        self._offset = offset
+        self._value = value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return "flight-searches"
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+
+def envelopes(lines):
+    """
+    :return messages: FakeMessages with the lines in json envelopes
+    """
+    return [
+        FakeMessage(i, json.dumps({"payload": {"column01": line.decode()}}).encode())
+        for i, line in enumerate(lines)
+    ]
+
+
+# fake consumer of a list of messages
+class FakeConsumer:
+    instances = []
+
+    def __init__(self, conf):
+        FakeConsumer.instances.append(self)
+        self.conf = conf
+        self.messages = []
+        self.committed = []
+        self.closed = False
+
+    def subscribe(self, topics):
+        pass
+
+    def consume(self, num_messages, timeout):
+        batch = self.messages[:num_messages]
+        del self.messages[:num_messages]
+        return batch
+
+    def commit(self, offsets, asynchronous):
+        self.committed.append([tp.offset for tp in offsets])
+
+    def get_watermark_offsets(self, partition, cached):
+        return 0, 6
+
+    def close(self):
+        self.closed = True
+
+
+def consume_until_sigterm(monkeypatch, messages):
+    """
+    Feeds the fake consumers with messages, then sets shutdown as a SIGTERM would
+    :return shutdown: Event replacing recoReader.shutdown
+    """
+    shutdown = recoReader.threading.Event()
+    monkeypatch.setattr(recoReader, "shutdown", shutdown)
+
+    def consume(self, num_messages, timeout):
+        if not messages:
+            shutdown.set()
+        batch = messages[:num_messages]
+        del messages[:num_messages]
+        return batch
+
+    monkeypatch.setattr(FakeConsumer, "consume", consume)
+    return shutdown
+
+
+def test_produce_to_kafka(monkeypatch):
+
+    monkeypatch.setattr(confluent_kafka, "Producer", FakeProducer)
+
+    stats = produce_to_kafka(iter([{"search_id": "1"}, {"search_id": "2"}]))
+    assert stats["produced"] == 2
+    assert stats["delivered"] == 2
+    assert stats["delivery_failed"] == 0
+    producer = FakeProducer.instances[-1]
+    assert [json.loads(value) for value in producer.delivered] == [
+        {"search_id": "1"},
+        {"search_id": "2"},
+    ]
+    assert producer.conf["compression.type"] == "lz4"
+
+
+def test_kafka_input(monkeypatch):
+
+    monkeypatch.setattr(confluent_kafka, "Consumer", FakeConsumer)
+
+    buffered = [None]
+
+    # grouping window with the first line of the searches being grouped
+    class window:
+        def first_line():
+            return buffered[0]
+
+    kafka_input = KafkaInput(batch_size=3)
+    kafka_input.window = window
+    consumer = FakeConsumer.instances[-1]
+    envelope = '{"payload": {"column01": "line %d"}}'
+    consumer.messages = [
+        FakeMessage(i, (envelope % i).encode()) for i in (0, 1, 2, 4, 5)
+    ]
+    # a message which is not a json envelope
+    consumer.messages.insert(3, FakeMessage(3, b"not json"))
+
+    batches = kafka_input.batches()
+    assert next(batches) == ["line 0", "line 1", "line 2"]
+    assert consumer.committed == []
+    assert next(batches) == ["line 4", "line 5"]
+    # first batch committed once the second one is requested
+    assert consumer.committed == [[3]]
+    assert consumer.conf["enable.auto.commit"] is False
+
+    # the fifth line (second batch) is still being grouped
+    buffered[0] = 5
+    consumer.messages.append(FakeMessage(6, (envelope % 6).encode()))
+    assert next(batches) == ["line 6"]
+    assert consumer.committed == [[3]]
+    # then in a search produced but not delivered yet
+    buffered[0] = None
+    list(kafka_input.track(iter([(5, ["reco"]), (6, ["reco"])])))
+    kafka_input.hand_over(5, {"search_id": "1"})
+    # the decoration of the other search failed: nothing to deliver
+    kafka_input.hand_over(6, None)
+    # no message: empty batch
+    assert next(batches) == []
+    assert consumer.committed == [[3]]
+    kafka_input.acknowledge(0, None)
+    consumer.messages.append(FakeMessage(7, (envelope % 7).encode()))
+    assert next(batches) == ["line 7"]
+    assert consumer.committed == [[3], [7]]
+    batches.close()
+
+    # the last batch is committed when closing
+    kafka_input.close()
+    assert consumer.committed == [[3], [7], [8]]
+    assert consumer.closed
+
+    # a failed delivery stops the commits
+    list(kafka_input.track(iter([(8, ["reco"])])))
+    kafka_input.hand_over(8, {"search_id": "2"})
+    kafka_input.acknowledge(1, "Broker down")
+    with pytest.raises(RuntimeError):
+        kafka_input.commit()
+
+
+@pytest.mark.parametrize("broker", ["up", "down", "failing"])
+def test_kafka_pipeline(monkeypatch, broker):
+
+    monkeypatch.setattr(confluent_kafka, "Consumer", FakeConsumer)
+    producer = FakeProducer({})
+    producer.down = broker == "down"
+    if broker == "failing":
+        producer.error = "Message timed out"
+    monkeypatch.setattr(recoReader, "create_producer", lambda: producer)
+    lines = list(process_input_file(csv_filename))
+    consume_until_sigterm(monkeypatch, envelopes(lines))
+
+    class args:
+        pass
+    args.input_file = None
+    args.rates_file = rates_file
+    args.consume_batch_size = 50
+
+    if broker == "failing":
+        # stops without committing: the input is consumed again on restart
+        with pytest.raises(RuntimeError):
+            kafka_pipeline(args, encoders["json"])
+        consumer = FakeConsumer.instances[-1]
+        assert consumer.closed
+        assert consumer.committed == []
+        return
+
+    stats = kafka_pipeline(args, encoders["json"])
+    consumer = FakeConsumer.instances[-1]
+    assert consumer.closed
+    if broker == "down":
+        # nothing delivered: all the messages are consumed again on restart
+        assert stats["delivery_failed"] == 2
+        assert consumer.committed == []
+    else:
+        # the searches flushed at shutdown are produced, then their lines committed
+        assert stats["delivered"] == 2
+        assert consumer.committed[-1] == [len(lines)]
+        # deliveries are not waited for at each batch
+        assert producer.flushes == 1
+
+
+def test_kafka_pipeline_pool(monkeypatch):
+
+    monkeypatch.setattr(confluent_kafka, "Consumer", FakeConsumer)
+    producer = FakeProducer({})
+    monkeypatch.setattr(recoReader, "create_producer", lambda: producer)
+    # a search is handed over as soon as the next one starts
+    monkeypatch.setattr(recoReader, "GROUP_MAX_SEARCHES", 1)
+    lines = list(TravelDataGenerator(seed=1, recos_per_search=5).lines(40))
+    consume_until_sigterm(monkeypatch, envelopes(lines))
+
+    # offsets committed before the searches of their lines were delivered
+    early = []
+
+    def commit(self, offsets, asynchronous):
+        delivered = {json.loads(value)["search_id"] for value in producer.delivered}
+        offset = offsets[0].offset
+        search_ids = {line.split(b"^")[1].decode() for line in lines[:offset]}
+        if not search_ids <= delivered:
+            early.append(offset)
+        self.committed.append([offset])
+
+    monkeypatch.setattr(FakeConsumer, "commit", commit)
+
+    class args:
+        pass
+    args.input_file = None
+    args.rates_file = rates_file
+    args.consume_batch_size = 7
+    args.workers = 2
+    args.max_in_flight = 4
+
+    stats = kafka_pipeline(args, encoders["json"])
+    assert stats["delivered"] == 40
+    consumer = FakeConsumer.instances[-1]
+    assert len(consumer.committed) > 1
+    assert early == []
+    assert consumer.committed[-1] == [len(lines)]
+
+
+def test_group_recos():
+
+    lines = list(process_input_file(csv_filename))
+    first = [line for line in lines if line.split(b"^")[1] == lines[0].split(b"^")[1]]
+    second = [line for line in lines if line not in first]
+    expected = [
+        [decode_line(line) for line in first],
+        [decode_line(line) for line in second],
+    ]
+
+    # interleaved searches are grouped back, in the order of their last reco
+    interleaved = [line for pair in zip(first, second) for line in pair]
+    interleaved += first[len(second) :] + second[len(first) :]
+    cnt = Counter()
+    groups = list(group_recos(interleaved, cnt))
+    assert sorted(groups, key=len) == sorted(expected, key=len)
+    assert cnt["search_read"] == 2
+
+    # one open search at a time: consecutive recos only
+    cnt = Counter()
+    groups = list(group_recos(interleaved[:6], cnt, SearchWindow(max_searches=1)))
+    assert len(groups) == 6
+    assert cnt["search_evicted"] == 5
+    assert cnt["reco_late"] == 4
+
+    # memory cap: least recently updated search flushed first
+    window = SearchWindow(max_recos=3)
+    cnt = Counter()
+    recos = [decode_line(line) for line in interleaved[:4]]
+    assert window.add(recos[0], 1, 0.0, cnt) == []
+    assert window.add(recos[1], 2, 0.0, cnt) == []
+    assert window.add(recos[2], 3, 0.0, cnt) == []
+    assert window.add(recos[3], 4, 0.0, cnt) == [(1, [recos[0], recos[2]])]
+    assert window.first_line() == 2
+
+    # idle searches
+    window = SearchWindow(idle_timeout=2)
+    window.add(recos[0], 1, 0.0, cnt)
+    window.add(recos[1], 2, 1.0, cnt)
+    assert window.expire(2.5) == [(1, [recos[0]])]
+    assert window.add(recos[2], 3, 3.5, cnt) == [(2, [recos[1]])]
+    assert window.flush() == [(3, [recos[2]])]
+    assert window.first_line() is None and window.recos == 0
+
+
+def test_compact_encoder():
+
+    class args:
+        pass
+    args.input_file = csv_filename
+    args.rates_file = rates_file
+
+    searches = list(process(args))
+    stream = io.BytesIO()
+    for search in searches:
+        encoded = encoders["compact"](search)
+        assert compactCodec.is_compact(encoded)
+        assert len(encoded) < len(encoders["json"](search)) / 3
+        # same dict, same key order
+        assert json.dumps(compactCodec.decode(encoded)) == json.dumps(search)
+        compactCodec.write_frame(stream, encoded)
+
+    # file output: length prefixed frames
+    stream.seek(0)
+    decoded = [compactCodec.decode(data) for data in compactCodec.read_frames(stream)]
+    assert json.dumps(decoded) == json.dumps(searches)
+    with pytest.raises(ValueError):
+        list(compactCodec.read_frames(io.BytesIO(stream.getvalue()[:-1])))
+
+    # the schema follows the CSV layouts
+    flight_fields = [name for name, _ in compactCodec.FLIGHT_SCHEMA]
+    assert flight_fields[: len(_FLIGHT_LAYOUT)] == _FLIGHT_LAYOUT
+    search_fields = [name for name, _ in compactCodec.SEARCH_SCHEMA]
+    assert search_fields[: len(_SEARCH_FIELDS)] == _SEARCH_FIELDS
+    reco_fields = [name for name, _ in compactCodec.RECO_SCHEMA]
+    assert _SEARCH_FIELDS + reco_fields[:4] == _RECO_LAYOUT
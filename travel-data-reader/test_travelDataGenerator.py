@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic data generator unit test
+
+> pytest
+
+"""
+
+import os
+from collections import Counter
+
+from recoReader import decode_lines, group_recos, group_and_decorate, load_rates
+from travelDataGenerator import TravelDataGenerator
+
+rates_file = os.path.join(os.path.dirname(__file__), "etc/eurofxref.csv")
+
+
+def test_generator():
+
+    lines = list(TravelDataGenerator(seed=1, recos_per_search=5).lines(50))
+    assert lines == list(TravelDataGenerator(seed=1, recos_per_search=5).lines(50))
+    assert lines != list(TravelDataGenerator(seed=2, recos_per_search=5).lines(50))
+
+    cnt = Counter()
+    recos = list(decode_lines(lines, cnt))
+    assert len(recos) == len(lines)
+    assert cnt["malformed_line"] == 0
+    for reco in recos:
+        nb_of_legs = 2 if reco["request_return_date"] else 1
+        assert nb_of_legs <= reco["nb_of_flights"] <= 2 * nb_of_legs
+
+    # every generated search can be decorated
+    rates = load_rates(rates_file)
+    groups = list(group_recos(lines, Counter()))
+    assert len(groups) == 50
+    for group in groups:
+        search = group_and_decorate(group, rates)
+        assert search["OnD"] == f"{search['origin_city']}-{search['destination_city']}"
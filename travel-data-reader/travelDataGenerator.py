@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+Seeded generator of synthetic travel data, in the CSV format read by recoReader.py
+(_RECO_LAYOUT and _FLIGHT_LAYOUT). Used by the benchmarks and to build test files.
+
+> python3 travelDataGenerator.py -h
+
+The same seed and options always produce the same lines. OnDs are drawn with a
+Zipf-like skew (a few OnDs get most of the searches, as in the real traffic), flights
+are direct or connect through hubs, and all the codes are known by neobase so that
+the lines can be decorated.
+
+"""
+
+import argparse
+import datetime
+import gzip
+import random
+import sys
+
+from recoReader import _RECO_LAYOUT, _FLIGHT_LAYOUT
+
+# cities and their airports
+CITY_AIRPORTS = {
+    "PAR": ["CDG", "ORY"],
+    "LON": ["LHR", "LGW"],
+    "NYC": ["JFK", "EWR"],
+    "LIS": ["LIS"],
+    "AMS": ["AMS"],
+    "MAD": ["MAD"],
+    "FRA": ["FRA"],
+    "MUC": ["MUC"],
+    "ROM": ["FCO"],
+    "BCN": ["BCN"],
+    "NCE": ["NCE"],
+    "IST": ["IST"],
+    "DXB": ["DXB"],
+    "SIN": ["SIN"],
+    "TYO": ["NRT", "HND"],
+    "MOW": ["SVO", "DME"],
+}
+# connection airports and the airline based there
+HUBS = {
+    "CDG": "AF",
+    "AMS": "KL",
+    "FRA": "LH",
+    "LHR": "BA",
+    "MAD": "IB",
+    "IST": "TK",
+    "DXB": "EK",
+}
+AIRLINES = ["AF", "KL", "LH", "BA", "IB", "TK", "EK", "TP", "U2", "FR"]
+CABINS = ["M", "M", "M", "M", "W", "C", "F"]
+PASSENGERS = ["ADT=1", "ADT=1", "ADT=2", "ADT=2,CH=1", "ADT=1,IT=1", "IT=2"]
+COUNTRIES = ["FR", "GB", "US", "DE", "ES", "RU", "IT", "NL"]
+CURRENCIES = ["EUR", "USD", "GBP", "RUB", "JPY", "CHF"]
+
+SEARCH_DATE = datetime.datetime(2021, 11, 17)
+
+
+def ond_weights(onds, skew):
+    """
+    :param onds: list of OnDs
+    :param skew: Zipf exponent, 0 for a uniform distribution
+    :return: weights of the OnDs
+    """
+    return [1 / (rank + 1) ** skew for rank in range(len(onds))]
+
+
+class TravelDataGenerator:
+    """
+    Generates the CSV lines of synthetic searches
+    """
+
+    def __init__(
+        self,
+        seed=0,
+        recos_per_search=20,
+        max_legs=2,
+        currencies=CURRENCIES,
+        ond_skew=1.0,
+        round_trip_ratio=0.7,
+    ):
+        """
+        :param seed: random seed
+        :param recos_per_search: average number of recos per search
+        :param max_legs: max number of flights per direction
+        :param currencies: currencies of the searches
+        :param ond_skew: Zipf exponent of the OnD distribution
+        :param round_trip_ratio: share of round trip searches
+        """
+        self.random = random.Random(seed)
+        self.recos_per_search = recos_per_search
+        self.max_legs = max_legs
+        self.currencies = list(currencies)
+        self.round_trip_ratio = round_trip_ratio
+        cities = sorted(CITY_AIRPORTS)
+        self.onds = [(o, d) for o in cities for d in cities if o != d]
+        self.random.shuffle(self.onds)
+        self.ond_weights = ond_weights(self.onds, ond_skew)
+        self.search_nb = 0
+
+    def time(self):
+        return f"{self.random.randrange(24):02d}:{self.random.randrange(0, 60, 5):02d}"
+
+    def flights(self, origin, destination, day, cabin):
+        """
+        :return flights: list of flight dicts from an origin city to a destination city
+        """
+        dep_airport = self.random.choice(CITY_AIRPORTS[origin])
+        arr_airport = self.random.choice(CITY_AIRPORTS[destination])
+        legs = self.random.randint(1, self.max_legs)
+        hubs = [h for h in HUBS if h not in (dep_airport, arr_airport)]
+        stops = self.random.sample(hubs, legs - 1)
+        airports = [dep_airport] + stops + [arr_airport]
+        airline = HUBS.get(stops[0]) if stops else self.random.choice(AIRLINES)
+
+        flights = []
+        for dep, arr in zip(airports, airports[1:]):
+            arr_day = day + datetime.timedelta(days=self.random.random() < 0.2)
+            flights.append(
+                {
+                    "dep_airport": dep,
+                    "dep_date": day.strftime("%Y-%m-%d"),
+                    "dep_time": self.time(),
+                    "arr_airport": arr,
+                    "arr_date": arr_day.strftime("%Y-%m-%d"),
+                    "arr_time": self.time(),
+                    "operating_airline": airline,
+                    "marketing_airline": airline
+                    if self.random.random() < 0.9
+                    else self.random.choice(AIRLINES),
+                    "flight_nb": str(self.random.randint(1, 9999)),
+                    "cabin": cabin,
+                }
+            )
+            day = arr_day
+        return flights
+
+    def search(self):
+        """
+        :return lines: CSV lines (bytes) of the recos of a new search
+        """
+        self.search_nb += 1
+        origin, destination = self.random.choices(self.onds, self.ond_weights)[0]
+        search_time = SEARCH_DATE + datetime.timedelta(
+            days=self.random.randrange(30), seconds=self.random.randrange(86400)
+        )
+        dep_date = search_time.date() + datetime.timedelta(
+            days=self.random.randrange(1, 300)
+        )
+        round_trip = self.random.random() < self.round_trip_ratio
+        return_date = dep_date + datetime.timedelta(days=self.random.randrange(15))
+        search = {
+            "version_nb": "1.0",
+            "search_id": f"GEN-{self.search_nb}-{int(search_time.timestamp())}",
+            "search_country": self.random.choice(COUNTRIES),
+            "search_date": search_time.strftime("%Y-%m-%d"),
+            "search_time": search_time.strftime("%H:%M:%S"),
+            "origin_city": origin,
+            "destination_city": destination,
+            "request_dep_date": dep_date.strftime("%Y-%m-%d"),
+            "request_return_date": return_date.strftime("%Y-%m-%d")
+            if round_trip
+            else "",
+            "passengers_string": self.random.choice(PASSENGERS),
+            "currency": self.random.choice(self.currencies),
+        }
+
+        lines = []
+        nb_of_recos = self.random.randint(1, 2 * self.recos_per_search - 1)
+        for _ in range(nb_of_recos):
+            cabin = self.random.choice(CABINS)
+            flights = self.flights(origin, destination, dep_date, cabin)
+            if round_trip:
+                flights += self.flights(destination, origin, return_date, cabin)
+            price = round(self.random.lognormvariate(6, 0.6), 2)
+            reco = dict(
+                search,
+                price=f"{price:.2f}",
+                taxes=f"{price * self.random.uniform(0.1, 0.4):.2f}",
+                fees="0.00",
+                nb_of_flights=str(len(flights)),
+            )
+            fields = [reco[name] for name in _RECO_LAYOUT]
+            for flight in flights:
+                fields += [flight[name] for name in _FLIGHT_LAYOUT]
+            lines.append(("^".join(fields) + "\n").encode())
+        return lines
+
+    def lines(self, searches):
+        """
+        :param searches: number of searches
+        :return: iterator on CSV lines (bytes), recos of a search are contiguous
+        """
+        for _ in range(searches):
+            yield from self.search()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Synthetic travel data generator")
+    parser.add_argument(
+        "output_file",
+        help="CSV file to write, gziped if it ends with .gz, - for standard output",
+    )
+    parser.add_argument(
+        "-n", "--searches", help="Number of searches", type=int, default=1000
+    )
+    parser.add_argument(
+        "--recos", help="Average number of recos per search", type=int, default=20
+    )
+    parser.add_argument(
+        "--legs", help="Max number of flights per direction", type=int, default=2
+    )
+    parser.add_argument(
+        "--currencies",
+        help="Comma separated currencies of the searches",
+        default=",".join(CURRENCIES),
+    )
+    parser.add_argument(
+        "--ond_skew",
+        help="Zipf exponent of the OnD distribution, 0 for uniform",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument("-s", "--seed", help="Random seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    generator = TravelDataGenerator(
+        arguments.seed,
+        arguments.recos,
+        arguments.legs,
+        arguments.currencies.split(","),
+        arguments.ond_skew,
+    )
+    if arguments.output_file == "-":
+        output = sys.stdout.buffer
+    elif arguments.output_file.endswith(".gz"):
+        output = gzip.open(arguments.output_file, "wb")
+    else:
+        output = open(arguments.output_file, "wb")
+    with output:
+        output.writelines(generator.lines(arguments.searches))